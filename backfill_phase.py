@@ -0,0 +1,285 @@
+import argparse
+import psycopg2
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+
+WINDOW_RUNNING = "running"
+WINDOW_COMPLETED = "completed"
+WINDOW_FAILED = "failed"
+
+
+class BackfillRunner:
+    def __init__(self, extractor, transformer_factory, loader_factory, redshift_params, backfill_metadata_table, etl_job_name, s3_partition_prefix, window_days, max_workers, logger, msg_text):
+        # Store the phase objects and the settings that control how windows are replayed. The transformer
+        # and loader keep per-run state (run_metrics), so every window builds its own from the factories.
+        self.extractor = extractor
+        self.transformer_factory = transformer_factory
+        self.loader_factory = loader_factory
+        self.redshift_params = redshift_params
+        self.backfill_metadata_table = backfill_metadata_table
+        self.etl_job_name = etl_job_name
+        self.s3_partition_prefix = s3_partition_prefix
+        self.window_days = window_days
+        self.max_workers = max_workers
+        self.logger = logger
+        self.msg_text = msg_text
+
+    def split_into_windows(self, start, end):
+        # Split [start, end) into consecutive windows of window_days each, the last one clipped to end
+        if start >= end:
+            raise ValueError(f"Backfill start {start} must be before end {end}")
+        step = timedelta(days=self.window_days)
+        windows = []
+        window_start = start
+        while window_start < end:
+            window_end = min(window_start + step, end)
+            windows.append((window_start, window_end))
+            window_start = window_end
+        return windows
+
+    def ensure_backfill_metadata_table(self):
+        # Create the table that tracks per-window progress if it does not exist yet
+        self.logger.info(f"Ensuring backfill metadata table: {self.backfill_metadata_table}")
+        try:
+            conn = psycopg2.connect(**self.redshift_params)
+            cur = conn.cursor()
+            cur.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {self.backfill_metadata_table} (
+                    job_name VARCHAR(256),
+                    window_start TIMESTAMP,
+                    window_end TIMESTAMP,
+                    status VARCHAR(16),
+                    row_count BIGINT,
+                    updated_at TIMESTAMP
+                )
+                """
+            )
+            conn.commit()
+            cur.close()
+            conn.close()
+        except Exception as e:
+            self.logger.error(f"{self.msg_text}: backfill metadata table Error: {str(e)}")
+            raise
+
+    def extract_completed_windows(self, start, end):
+        # Get the windows inside [start, end) that a previous backfill already finished
+        self.logger.info(f"Extracting completed backfill windows for job: {self.etl_job_name}")
+        try:
+            with psycopg2.connect(**self.redshift_params) as conn:
+                with conn.cursor() as cursor:
+                    cursor.execute(
+                        f"""
+                        SELECT window_start, window_end
+                        FROM {self.backfill_metadata_table}
+                        WHERE job_name = %s
+                          AND status = %s
+                          AND window_start >= %s
+                          AND window_end <= %s
+                        """,
+                        (self.etl_job_name, WINDOW_COMPLETED, start, end),
+                    )
+                    return {(row[0], row[1]) for row in cursor.fetchall()}
+        except Exception as e:
+            self.logger.error(f"{self.msg_text}: extract completed windows Error: {str(e)}")
+            raise
+
+    def update_window_status(self, window_start, window_end, status, row_count=None):
+        # Record the latest status of a window, replacing any earlier record for it
+        self.logger.info(f"Marking window [{window_start}, {window_end}) as {status}")
+        try:
+            conn = psycopg2.connect(**self.redshift_params)
+            cur = conn.cursor()
+            cur.execute(
+                f"""
+                DELETE FROM {self.backfill_metadata_table}
+                WHERE job_name = %s AND window_start = %s AND window_end = %s
+                """,
+                (self.etl_job_name, window_start, window_end),
+            )
+            cur.execute(
+                f"""
+                INSERT INTO {self.backfill_metadata_table}
+                    (job_name, window_start, window_end, status, row_count, updated_at)
+                VALUES (%s, %s, %s, %s, %s, GETDATE())
+                """,
+                (self.etl_job_name, window_start, window_end, status, row_count),
+            )
+            conn.commit()
+            cur.close()
+            conn.close()
+        except Exception as e:
+            self.logger.error(f"{self.msg_text}: update backfill window status Error: {str(e)}")
+            raise
+
+    def build_window_object_keys(self, window_start):
+        # Give every window its own raw and transformed S3 keys so parallel windows never collide
+        window_tag = window_start.strftime("%Y%m%dT%H%M%S")
+        raw_s3_object_key = f"data/backfill/{self.etl_job_name}/{window_tag}.csv"
+        s3_object_key = f"{self.s3_partition_prefix}backfill/{self.etl_job_name}/{window_tag}.csv"
+        return raw_s3_object_key, s3_object_key
+
+    def run_window(self, window_start, window_end):
+        # Run extract -> transform -> load for a single window without touching the live watermark
+        self.logger.info(f"Starting backfill window [{window_start}, {window_end})")
+        try:
+            self.update_window_status(window_start, window_end, WINDOW_RUNNING)
+            raw_s3_object_key, s3_object_key = self.build_window_object_keys(window_start)
+            loader = self.loader_factory()
+            row_count = self.extractor.run_window_extraction(window_start, window_end, raw_s3_object_key)
+            if row_count:
+                # Every row of the window is written back, so change detection is off. The transform
+                # may split its output into several files and hands back their keys.
+                _, s3_object_key = self.transformer_factory().run_transformation(raw_s3_object_key, s3_object_key, detect_changes=False)
+                # Rows already loaded for these ids are deleted in the same transaction as the insert
+                loader.run_loading(None, s3_object_key, update_watermark=False, delete_duplicates=False, replace_existing_ids=True)
+            loader.cleanup_s3(raw_s3_object_key)
+            self.update_window_status(window_start, window_end, WINDOW_COMPLETED, row_count)
+            self.logger.info(f"Backfill window [{window_start}, {window_end}) completed with {row_count} records")
+            return row_count
+        except Exception as e:
+            self.logger.error(f"{self.msg_text}: Backfill window [{window_start}, {window_end}) failed: {str(e)}")
+            try:
+                self.update_window_status(window_start, window_end, WINDOW_FAILED)
+            except Exception:
+                pass
+            raise
+
+    def run_backfill(self, start, end):
+        # Main entry point for the backfill: replay [start, end) window by window in parallel
+        self.logger.info(f"Starting backfill for [{start}, {end}) with {self.max_workers} workers")
+        try:
+            windows = self.split_into_windows(start, end)
+            self.ensure_backfill_metadata_table()
+            completed_windows = self.extract_completed_windows(start, end)
+            pending_windows = [window for window in windows if window not in completed_windows]
+            self.logger.info(
+                f"{len(windows)} windows in range, {len(windows) - len(pending_windows)} already completed, "
+                f"{len(pending_windows)} to run"
+            )
+
+            failed_windows = []
+            loaded_rows = 0
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = {executor.submit(self.run_window, *window): window for window in pending_windows}
+                for future in as_completed(futures):
+                    try:
+                        loaded_rows += future.result()
+                    except Exception:
+                        failed_windows.append(futures[future])
+
+            # Deduplicate once at the end instead of racing a table-wide DELETE from every window
+            if loaded_rows:
+                loader = self.loader_factory()
+                loader.delete_duplicates_from_redshift()
+                loader.maintain_table()
+
+            if failed_windows:
+                failed_windows.sort()
+                raise RuntimeError(f"{len(failed_windows)} backfill windows failed: {failed_windows}")
+            self.logger.info(f"Backfill completed successfully, {loaded_rows} records loaded")
+            return loaded_rows
+        except Exception as e:
+            self.logger.error(f"{self.msg_text}: Backfill failed: {str(e)}")
+            raise
+
+
+def main():
+    # Command line entry point: python backfill_phase.py --start 2025-07-01 --end 2025-08-01
+    from config import (
+        REDSHIFT_PARAMS,
+        MONGO_CONNECTION_STRING,
+        MONGO_DATABASE,
+        MONGO_COLLECTION,
+        S3_BUCKET_NAME,
+        AWS_ACCESS_KEY_ID,
+        AWS_SECRET_ACCESS_KEY,
+        ETL_JOB_NAME,
+        MSG_TEXT,
+        logger,
+        EGYPT_TZ,
+        COLUMNS_TO_SELECT,
+        DATA_TYPES,
+        REDSHIFT_TABLE,
+        S3_PARTITION_PREFIX,
+        REGION_NAME,
+        DELIVERIES_ATTEMPTS_COLUMNS,
+        REDSHIFT_TABLE_DESIGN,
+        REDSHIFT_COPY_OPTIONS,
+        VALIDATION_SCHEMA,
+        STAGING_BACKEND,
+        LOCAL_STAGING_DIR,
+        TARGET_WAREHOUSE,
+        THROUGHPUT_BUDGETS,
+        BACKFILL_METADATA_TABLE,
+        BACKFILL_WINDOW_DAYS,
+        BACKFILL_MAX_WORKERS,
+    )
+    from extract_phase import DataExtractor
+    from transform_phase import DataTransformer
+    from load_phase import DataLoader
+    from staging_storage import build_staging_storage
+
+    parser = argparse.ArgumentParser(description="Replay a historical [start, end) range of delivery attempts")
+    parser.add_argument("--start", required=True, type=datetime.fromisoformat, help="Inclusive range start (ISO format)")
+    parser.add_argument("--end", required=True, type=datetime.fromisoformat, help="Exclusive range end (ISO format)")
+    parser.add_argument("--max-workers", type=int, default=BACKFILL_MAX_WORKERS, help="Windows to run in parallel")
+    args = parser.parse_args()
+
+    staging_storage = build_staging_storage(STAGING_BACKEND, S3_BUCKET_NAME, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, REGION_NAME, LOCAL_STAGING_DIR)
+
+    extractor = DataExtractor(
+        redshift_params=REDSHIFT_PARAMS,
+        mongo_connection_string=MONGO_CONNECTION_STRING,
+        mongo_database=MONGO_DATABASE,
+        mongo_collection=MONGO_COLLECTION,
+        s3_bucket_name=S3_BUCKET_NAME,
+        aws_access_key_id=AWS_ACCESS_KEY_ID,
+        aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+        etl_job_name=ETL_JOB_NAME,
+        logger=logger,
+        msg_text=MSG_TEXT,
+        staging_storage=staging_storage,
+        throughput_budgets=THROUGHPUT_BUDGETS,
+    )
+    def transformer_factory():
+        return DataTransformer(EGYPT_TZ, COLUMNS_TO_SELECT, MSG_TEXT, logger, DATA_TYPES, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, S3_BUCKET_NAME, S3_PARTITION_PREFIX, REGION_NAME, VALIDATION_SCHEMA, staging_storage, output_file_count=REDSHIFT_COPY_OPTIONS["file_count"])
+
+    def loader_factory():
+        return DataLoader(
+            logger,
+            REDSHIFT_PARAMS,
+            S3_BUCKET_NAME,
+            S3_PARTITION_PREFIX,
+            AWS_ACCESS_KEY_ID,
+            AWS_SECRET_ACCESS_KEY,
+            REGION_NAME,
+            MSG_TEXT,
+            ETL_JOB_NAME,
+            REDSHIFT_TABLE,
+            DELIVERIES_ATTEMPTS_COLUMNS,
+            DATA_TYPES,
+            REDSHIFT_TABLE_DESIGN,
+            REDSHIFT_COPY_OPTIONS,
+            staging_storage,
+            target_warehouse=TARGET_WAREHOUSE,
+        )
+
+    runner = BackfillRunner(
+        extractor,
+        transformer_factory,
+        loader_factory,
+        REDSHIFT_PARAMS,
+        BACKFILL_METADATA_TABLE,
+        ETL_JOB_NAME,
+        S3_PARTITION_PREFIX,
+        BACKFILL_WINDOW_DAYS,
+        args.max_workers,
+        logger,
+        MSG_TEXT,
+    )
+    runner.run_backfill(args.start, args.end)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+import argparse
+import io
+import logging
+import tempfile
+import timeit
+import numpy as np
+import pandas as pd
+
+from config import EGYPT_TZ, COLUMNS_TO_SELECT, MSG_TEXT, DATA_TYPES, REGION_NAME, VALIDATION_SCHEMA
+from transform_kernels import normalize_nan_tokens, strip_and_truncate, normalize_tristate_boolean
+from transform_phase import DataTransformer
+from staging_storage import LocalStagingStorage
+
+STRING_COLUMNS = ["business_name", "star_name", "exception_reason", "consignee_name", "route_id", "star_phone"]
+MAX_LENGTHS = {"business_name": 300, "star_name": 300, "exception_reason": 200, "consignee_name": 150}
+STRIP_COLUMNS = ["exception_reason", "consignee_name"]
+
+
+def make_string_block(rows, seed=0):
+    # Build a block of string columns with NaN tokens and over-long values mixed in
+    rng = np.random.default_rng(seed)
+    pool = np.array(["nan", "NaN", "NAN", "NaT", "  padded value  ", "x" * 400, "Cairo Warehouse", ""], dtype=object)
+    data = {col: pool[rng.integers(0, len(pool), rows)] for col in STRING_COLUMNS}
+    block = pd.DataFrame(data)
+    block.iloc[::17, 0] = np.nan
+    return block
+
+
+def make_boolean_series(rows, seed=0):
+    # Build a boolean-ish column the way it comes out of the CSV round trip
+    rng = np.random.default_rng(seed)
+    pool = np.array([True, False, "True", "False", "nan", "", np.nan], dtype=object)
+    return pd.Series(pool[rng.integers(0, len(pool), rows)])
+
+
+def make_flattened_frame(rows, seed=0, invalid_every=None):
+    # Build a frame shaped like flatten_mongo_data output, optionally with rows that break the schema
+    rng = np.random.default_rng(seed)
+    timestamps = pd.Timestamp("2025-08-01") + pd.to_timedelta(rng.integers(0, 86400 * 30, rows), unit="s")
+    timestamp_text = timestamps.strftime("%Y-%m-%d %H:%M:%S").to_numpy(dtype=object)
+    df = pd.DataFrame({col: np.full(rows, "value", dtype=object) for col in COLUMNS_TO_SELECT})
+    df["_id"] = [f"{i:024x}" for i in range(rows)]
+    df["trackingNumber"] = rng.integers(1_000_000, 9_999_999, rows).astype(str)
+    df["state"] = rng.integers(0, 10, rows)
+    for col in [
+        "createdAt",
+        "updatedAt",
+        "attemptDate",
+        "exception.time",
+        "exception.whatsAppVerification.time",
+        "exception.whatsAppVerification.conversationStatus.time",
+        "exception.whatsAppVerification.consigneeRescheduleData.rescheduleDate",
+    ]:
+        df[col] = timestamp_text
+    for col in [
+        "exception.fakeAttempt",
+        "exception.whatsAppVerification.fakeAttempt",
+        "exception.whatsAppVerification.conversationStatus.conversationStartedSuccessfully",
+    ]:
+        df[col] = rng.integers(0, 2, rows).astype(bool)
+    if invalid_every:
+        df.loc[::invalid_every, "trackingNumber"] = "not-a-number"
+    return df
+
+
+def make_transformer():
+    # A transformer with a quiet logger and no S3 side effects
+    quiet_logger = logging.getLogger("benchmarks")
+    quiet_logger.setLevel(logging.ERROR)
+    transformer = DataTransformer(EGYPT_TZ, COLUMNS_TO_SELECT, MSG_TEXT, quiet_logger, DATA_TYPES, None, None, None, "/", REGION_NAME, VALIDATION_SCHEMA, LocalStagingStorage(tempfile.mkdtemp()))
+    transformer.quarantine_rows_to_s3 = lambda quarantined_df, raw_s3_object_key: None
+    return transformer
+
+
+def make_raw_csv(rows, invalid_every=None):
+    # The raw CSV the extract phase would have staged for these rows
+    return make_flattened_frame(rows, invalid_every=invalid_every).to_csv(index=False).encode()
+
+
+def run_in_memory_transform(transformer, raw_csv, validate):
+    # The transform steps between download and upload, optionally with the validation stage
+    df = transformer.flatten_mongo_data(pd.read_csv(io.BytesIO(raw_csv)))
+    df = transformer.select_required_columns(df)
+    df = transformer.clean_column_names(df)
+    df = transformer.rename_columns_to_standard_format(df)
+    df = transformer.handle_initial_boolean_columns(df)
+    if validate:
+        df = transformer.validate_rows(df)
+    df = transformer.apply_data_types_and_handle_missing_columns(df)
+    df = transformer.clean_string_columns_and_handle_nan_values(df)
+    df = transformer.truncate_string_columns_to_limits(df)
+    df = transformer.handle_final_boolean_column_processing(df)
+    return transformer.handle_final_datetime_column_formatting(df)
+
+
+def legacy_normalize_nan_tokens(block):
+    for col in block.columns:
+        block[col] = block[col].replace({np.nan: "", "nan": "", "NAN": "", "NaN": "", "NaT": ""})
+    return block
+
+
+def legacy_strip_and_truncate(block):
+    block[["business_name", "star_name"]] = block[["business_name", "star_name"]].apply(lambda x: x.str.slice(0, 300))
+    block["exception_reason"] = block["exception_reason"].str.strip().str.slice(0, 200)
+    block["consignee_name"] = block["consignee_name"].str.strip().str.slice(0, 150)
+    return block
+
+
+def legacy_boolean(series):
+    series = series.replace("nan", np.nan)
+    series = series.astype("bool", errors="ignore")
+    return series.fillna(False)
+
+
+def bench_normalize_nan_tokens(rows, repeat):
+    block = make_string_block(rows)
+    return {
+        "legacy": min(timeit.repeat(lambda: legacy_normalize_nan_tokens(block.copy()), number=1, repeat=repeat)),
+        "kernel": min(timeit.repeat(lambda: normalize_nan_tokens(block), number=1, repeat=repeat)),
+    }
+
+
+def bench_strip_and_truncate(rows, repeat):
+    block = normalize_nan_tokens(make_string_block(rows))
+    columns = list(MAX_LENGTHS)
+    return {
+        "legacy": min(timeit.repeat(lambda: legacy_strip_and_truncate(block[columns].copy()), number=1, repeat=repeat)),
+        "kernel": min(timeit.repeat(lambda: strip_and_truncate(block[columns], MAX_LENGTHS, STRIP_COLUMNS), number=1, repeat=repeat)),
+    }
+
+
+def bench_normalize_tristate_boolean(rows, repeat):
+    series = make_boolean_series(rows)
+    return {
+        "legacy": min(timeit.repeat(lambda: legacy_boolean(series.copy()), number=1, repeat=repeat)),
+        "kernel": min(timeit.repeat(lambda: normalize_tristate_boolean(series), number=1, repeat=repeat)),
+    }
+
+
+def bench_validate_rows(rows, repeat):
+    # Overhead of the validation stage on the whole transform. The baseline needs input without
+    # malformed rows because astype would fail on them; runs are interleaved to even out noise.
+    transformer = make_transformer()
+    clean_csv = make_raw_csv(rows)
+    dirty_csv = make_raw_csv(rows, invalid_every=1000)
+    timings = {"transform": [], "transform+validation": [], "transform+validation+quarantine": []}
+    for _ in range(repeat):
+        timings["transform"] += timeit.repeat(lambda: run_in_memory_transform(transformer, clean_csv, False), number=1, repeat=1)
+        timings["transform+validation"] += timeit.repeat(lambda: run_in_memory_transform(transformer, clean_csv, True), number=1, repeat=1)
+        timings["transform+validation+quarantine"] += timeit.repeat(lambda: run_in_memory_transform(transformer, dirty_csv, True), number=1, repeat=1)
+    result = {label: min(seconds) for label, seconds in timings.items()}
+    overhead = (result["transform+validation"] - result["transform"]) / result["transform"]
+    result["overhead"] = f"{overhead:.1%} (budget 5%)"
+    return result
+
+
+BENCHMARKS = {
+    "normalize_nan_tokens": bench_normalize_nan_tokens,
+    "strip_and_truncate": bench_strip_and_truncate,
+    "normalize_tristate_boolean": bench_normalize_tristate_boolean,
+    "validate_rows": bench_validate_rows,
+}
+
+
+def main():
+    # Micro-benchmarks for the transform stages: python benchmarks.py --rows 200000
+    parser = argparse.ArgumentParser(description="Run transform micro-benchmarks")
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("names", nargs="*", default=list(BENCHMARKS), help="Benchmarks to run")
+    args = parser.parse_args()
+
+    for name in args.names:
+        timings = BENCHMARKS[name](args.rows, args.repeat)
+        line = ", ".join(
+            f"{label}={value * 1000:.1f}ms" if isinstance(value, float) else f"{label}={value}"
+            for label, value in timings.items()
+        )
+        print(f"{name} ({args.rows} rows): {line}")
+
+
+if __name__ == "__main__":
+    main()
@@ -39,11 +39,88 @@ S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
 S3_PARTITION_PREFIX = "/"
 REDSHIFT_TABLE = os.getenv("REDSHIFT_TABLE")
 
+# Staging area between the phases: "s3" (default) or "local" for development and single-node runs
+STAGING_BACKEND = os.getenv("STAGING_BACKEND", "s3")
+LOCAL_STAGING_DIR = os.getenv("LOCAL_STAGING_DIR", os.path.join(os.path.dirname(__file__), "staging"))
+# Database REDSHIFT_PARAMS points at: "redshift" (default) or "postgres" for development. Local staging
+# can only be loaded into Postgres, which gets the files through COPY FROM STDIN.
+TARGET_WAREHOUSE = os.getenv("TARGET_WAREHOUSE", "redshift")
+
+# SQLite file every phase appends its per-step timings to, read by `python performance_log.py`
+PERFORMANCE_HISTORY_PATH = os.getenv("PERFORMANCE_HISTORY_PATH", os.path.join(os.path.dirname(__file__), "performance_history.sqlite"))
+
+# Redshift physical design and maintenance for the target table
+REDSHIFT_TABLE_DESIGN = {
+    "distkey": "id",
+    "sortkey": "updatedAt",
+    "default_varchar_length": 256,
+    "varchar_lengths": {
+        "business_name": 300,
+        "star_name": 300,
+        "exception_reason": 200,
+        "consignee_name": 150,
+    },
+    # Columns whose Redshift type differs from what DATA_TYPES would map to
+    "type_overrides": {
+        "exception_whatsAppVerification_verified": "BOOLEAN",
+    },
+    # Run ALTER DISTKEY/SORTKEY when an existing table does not match, otherwise only warn
+    "enforce": False,
+    # Share of not-yet-vacuumed deleted rows that triggers VACUUM DELETE ONLY + ANALYZE
+    "vacuum_deleted_ratio_threshold": 0.05,
+}
+
+# Options for the Redshift COPY that loads the transformed files
+REDSHIFT_COPY_OPTIONS = {
+    # The transform stages CSV, the only format accepted here
+    "format": "CSV",
+    # Skip the compression analysis COPY would run on an empty table; encodings come from the DDL
+    "compupdate": False,
+    # None keeps Redshift's default; maintain_table already runs ANALYZE after large deletes
+    "statupdate": None,
+    # Rejected rows tolerated before the COPY fails; they are listed in the load report either way.
+    # Anything above 0 turns change detection off, the row hash index cannot tell rejected rows apart.
+    "maxerror": 0,
+    "timeformat": "auto",
+    # Files the transform splits its output into. A multiple of the cluster's slice count lets
+    # every slice load in parallel; more than one file is always loaded through a manifest.
+    "file_count": int(os.getenv("REDSHIFT_COPY_FILE_COUNT", 1)),
+    # Load through a manifest even for a single file
+    "manifest": False,
+    # Rows from stl_load_errors kept in the load report
+    "max_reported_errors": 100,
+}
+
+
+# Budgets for the adaptive Mongo page size, staged chunk size and S3 multipart part size
+THROUGHPUT_BUDGETS = {
+    "initial_batch_size": 1000,
+    "min_batch_size": 100,
+    "max_batch_size": 20000,
+    "target_batch_seconds": 1.0,
+    # Caps one Mongo page, one staged chunk and one upload part; the extracted batch itself is
+    # held in memory in full before staging and is not bounded by this
+    "memory_budget_bytes": 256 * 1024 * 1024,
+    "min_part_size": 5 * 1024 * 1024,
+    "max_part_size": 128 * 1024 * 1024,
+    "target_part_seconds": 2.0,
+    # Server-side limit per Mongo page, None to disable
+    "max_time_ms": 60000,
+}
+
 
 # Constants for date handling
 ETL_JOB_NAME = "deliveryAttempts"
 EGYPT_TZ = pytz.timezone("Africa/Cairo")
 
+# Days an id stays in the change-detection hash index after it was last seen by a run
+ROW_HASH_INDEX_RETENTION_DAYS = int(os.getenv("ROW_HASH_INDEX_RETENTION_DAYS", 30))
+
+# Backfill settings
+BACKFILL_METADATA_TABLE = "interns.etl_backfill_metadata"
+BACKFILL_WINDOW_DAYS = 1
+BACKFILL_MAX_WORKERS = int(os.getenv("BACKFILL_MAX_WORKERS", 4))
+
 
 # Data schema
 COLUMNS_TO_SELECT = [
@@ -134,4 +211,28 @@ DELIVERIES_ATTEMPTS_COLUMNS = [
     "conversationStartedSuccessfully",
     "exception_conversationStatus_time",
     "consignee_rescheduleDate"
-]
\ No newline at end of file
+]
+
+# Data-quality validation applied to the renamed frame before types are enforced.
+# String columns that the transform truncates to their byte limits are left out of the max_length check.
+NON_NULLABLE_COLUMNS = ["id", "createdAt", "updatedAt"]
+TRUNCATED_STRING_COLUMNS = ["business_name", "star_name", "exception_reason", "consignee_name"]
+# Delivery attempt state codes accepted by the pipeline, comma-separated in the ALLOWED_STATES env
+# variable; rows with any other state are quarantined. Empty keeps the check off until the codes are known.
+ALLOWED_STATES = [int(state) for state in os.getenv("ALLOWED_STATES", "").split(",") if state.strip()]
+
+VALIDATION_SCHEMA = {
+    column_name: {
+        "dtype": dtype,
+        "nullable": column_name not in NON_NULLABLE_COLUMNS,
+        "max_length": (
+            REDSHIFT_TABLE_DESIGN["varchar_lengths"].get(column_name, REDSHIFT_TABLE_DESIGN["default_varchar_length"])
+            if dtype == "str"
+            and column_name not in TRUNCATED_STRING_COLUMNS
+            and column_name not in REDSHIFT_TABLE_DESIGN["type_overrides"]
+            else None
+        ),
+        "allowed_values": ALLOWED_STATES if column_name == "state" and ALLOWED_STATES else None,
+    }
+    for column_name, dtype in DATA_TYPES.items()
+}
@@ -4,6 +4,8 @@ from datetime import datetime, timedelta
 from extract_phase import DataExtractor
 from transform_phase import DataTransformer
 from load_phase import DataLoader
+from staging_storage import build_staging_storage
+from performance_log import PerformanceHistory
 from airflow.utils.dates import days_ago
 
 from config import (
@@ -23,9 +25,24 @@ from config import (
     REDSHIFT_TABLE,
     S3_PARTITION_PREFIX,
     REGION_NAME,
-    DELIVERIES_ATTEMPTS_COLUMNS
+    DELIVERIES_ATTEMPTS_COLUMNS,
+    REDSHIFT_TABLE_DESIGN,
+    REDSHIFT_COPY_OPTIONS,
+    TARGET_WAREHOUSE,
+    VALIDATION_SCHEMA,
+    STAGING_BACKEND,
+    LOCAL_STAGING_DIR,
+    THROUGHPUT_BUDGETS,
+    PERFORMANCE_HISTORY_PATH,
+    ROW_HASH_INDEX_RETENTION_DAYS
 )
 
+def get_staging_storage():
+    return build_staging_storage(STAGING_BACKEND, S3_BUCKET_NAME, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, REGION_NAME, LOCAL_STAGING_DIR)
+
+def get_performance_history():
+    return PerformanceHistory(PERFORMANCE_HISTORY_PATH, logger)
+
 def extract_task(**context):
     extractor = DataExtractor(
         redshift_params=REDSHIFT_PARAMS,
@@ -38,16 +55,23 @@ def extract_task(**context):
         etl_job_name=ETL_JOB_NAME,
         logger=logger,
         msg_text=MSG_TEXT,
+        staging_storage=get_staging_storage(),
+        throughput_budgets=THROUGHPUT_BUDGETS,
+        performance_history=get_performance_history(),
     )
-    extracted_date = extractor.run_extraction()
+    extracted_date = extractor.run_extraction(run_id=context['run_id'])
+    context['ti'].xcom_push(key='extract_metrics', value=extractor.run_metrics)
     
 def transform_task(**context):
 
-    transformer = DataTransformer(EGYPT_TZ, COLUMNS_TO_SELECT, MSG_TEXT, logger, DATA_TYPES, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, S3_BUCKET_NAME, S3_PARTITION_PREFIX, REGION_NAME)
-    last_updated_at, s3_object_key = transformer.run_transformation()
+    transformer = DataTransformer(EGYPT_TZ, COLUMNS_TO_SELECT, MSG_TEXT, logger, DATA_TYPES, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, S3_BUCKET_NAME, S3_PARTITION_PREFIX, REGION_NAME, VALIDATION_SCHEMA, get_staging_storage(), get_performance_history(), REDSHIFT_COPY_OPTIONS["file_count"], ROW_HASH_INDEX_RETENTION_DAYS)
+    # Change detection is off while COPY may reject rows, see DataLoader.supports_change_detection
+    detect_changes = not REDSHIFT_COPY_OPTIONS["maxerror"]
+    last_updated_at, s3_object_key = transformer.run_transformation(detect_changes=detect_changes, run_id=context['run_id'])
 
     context['ti'].xcom_push(key='last_updated_at', value=last_updated_at)
     context['ti'].xcom_push(key='s3_object_key', value=s3_object_key)
+    context['ti'].xcom_push(key='transform_metrics', value=transformer.run_metrics)
 
 def load_task(**context):
     last_updated_at = context['ti'].xcom_pull(key='last_updated_at')
@@ -66,9 +90,16 @@ def load_task(**context):
         MSG_TEXT,
         ETL_JOB_NAME,
         REDSHIFT_TABLE,
-        DELIVERIES_ATTEMPTS_COLUMNS
+        DELIVERIES_ATTEMPTS_COLUMNS,
+        DATA_TYPES,
+        REDSHIFT_TABLE_DESIGN,
+        REDSHIFT_COPY_OPTIONS,
+        get_staging_storage(),
+        get_performance_history(),
+        TARGET_WAREHOUSE
     )
-    loader.run_loading(last_updated_at, s3_object_key)
+    loader.run_loading(last_updated_at, s3_object_key, run_id=context['run_id'])
+    context['ti'].xcom_push(key='load_metrics', value=loader.run_metrics)
 
 
 default_args = {
@@ -1,8 +1,13 @@
+import time
+import bson
 import psycopg2
 import pymongo
-import boto3
-import io
 import pandas as pd
+from staging_storage import S3StagingStorage
+from throughput_controller import ThroughputController
+from performance_log import RunRecorder
+
+RAW_S3_OBJECT_KEY = "data/delivery_attempts.csv"
 
 class DataExtractor:
     def __init__(
@@ -16,7 +21,10 @@ class DataExtractor:
         aws_secret_access_key,
         etl_job_name,
         logger,
-        msg_text
+        msg_text,
+        staging_storage=None,
+        throughput_budgets=None,
+        performance_history=None
     ):
         # Set up all the connections and config needed for extraction
         self.redshift_params = redshift_params
@@ -29,6 +37,76 @@ class DataExtractor:
         self.etl_job_name = etl_job_name
         self.logger = logger
         self.msg_text = msg_text
+        # Where extracted batches are handed to the transform; S3 unless a local backend is passed in
+        self.staging_storage = staging_storage or S3StagingStorage(
+            s3_bucket_name, aws_access_key_id, aws_secret_access_key, None
+        )
+        self.throughput_budgets = throughput_budgets or {}
+        self.performance_history = performance_history
+        self.run_metrics = {}
+
+    def build_throughput_controller(self):
+        # A fresh controller per run; windows of a backfill each get their own
+        return ThroughputController(self.logger, **self.throughput_budgets)
+
+    def build_page_query(self, query, last_doc):
+        # Keyset condition for the next page in (updatedAt, _id) order, combined with the run's filter
+        if last_doc is None:
+            return query
+        last_updated_at = last_doc.get("updatedAt")
+        if last_updated_at is None:
+            # Documents without updatedAt sort first; $gt null matches nothing, so page past them explicitly
+            after_last = {"$or": [{"updatedAt": None, "_id": {"$gt": last_doc["_id"]}}, {"updatedAt": {"$ne": None}}]}
+        else:
+            after_last = {
+                "$or": [
+                    {"updatedAt": {"$gt": last_updated_at}},
+                    {"updatedAt": last_updated_at, "_id": {"$gt": last_doc["_id"]}},
+                ]
+            }
+        return {"$and": [query, after_last]} if query else after_last
+
+    def check_mongo_index(self, collection):
+        # The (updatedAt, _id) sort needs a matching index, without one Mongo sorts every page in memory
+        # and fails once the sort passes its memory limit. Building it is left to the DBA, we only warn.
+        page_order = ([("updatedAt", 1), ("_id", 1)], [("updatedAt", -1), ("_id", -1)])
+        for index in collection.index_information().values():
+            if list(index["key"])[:2] in page_order:
+                return True
+        self.logger.warning(
+            f"{self.msg_text}: {self.mongo_collection} has no {{updatedAt: 1, _id: 1}} index, every page is sorted "
+            f"in memory. Create it with db.{self.mongo_collection}.createIndex({{updatedAt: 1, _id: 1}})"
+        )
+        return False
+
+    def iter_mongo_pages(self, collection, query, controller):
+        # Page through the query in (updatedAt, _id) order so each page can use the batch size the
+        # controller picked. Ordering on the filtered field lets Mongo walk the updatedAt index
+        # (ideally {updatedAt: 1, _id: 1}) instead of scanning _id past non-matching documents.
+        last_doc = None
+        while True:
+            page_size = controller.batch_size
+            started = time.perf_counter()
+            cursor = (
+                collection.find(self.build_page_query(query, last_doc))
+                .sort([("updatedAt", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)])
+                .limit(page_size)
+                .batch_size(page_size)
+            )
+            if controller.max_time_ms:
+                cursor = cursor.max_time_ms(controller.max_time_ms)
+            page = list(cursor)
+            seconds = time.perf_counter() - started
+            if not page:
+                return
+            # Encoding every document again would cost more than it tells us, a sample is enough
+            sample = page[:20]
+            page_bytes = int(sum(len(bson.encode(doc)) for doc in sample) / len(sample) * len(page))
+            controller.record_read(len(page), page_bytes, seconds)
+            yield page
+            if len(page) < page_size:
+                return
+            last_doc = page[-1]
 
     def extract_last_updated_date(self):
         # Get the last time we updated this job from Redshift metadata
@@ -52,15 +130,27 @@ class DataExtractor:
             self.logger.error(f"Error extracting last_updated_at: {e}")
             raise
 
-    def extract_mongo_data(self, last_updated_date):
-        # Pull new or updated records from MongoDB since the last update
+    def extract_mongo_data(self, last_updated_date, end_date=None, controller=None):
+        # Pull new or updated records from MongoDB since the last update,
+        # optionally bounded above by end_date (exclusive) for backfill windows
         self.logger.info("Starting MongoDB data extraction")
+        controller = controller or self.build_throughput_controller()
         try:
             client = pymongo.MongoClient(self.mongo_connection_string)
             db = client[self.mongo_database]
             collection = db[self.mongo_collection]
-            query = {"updatedAt": {"$gte": last_updated_date}} if last_updated_date else {}
-            cursor = list(collection.find(query))
+            updated_at_filter = {}
+            if last_updated_date:
+                updated_at_filter["$gte"] = last_updated_date
+            if end_date:
+                updated_at_filter["$lt"] = end_date
+            query = {"updatedAt": updated_at_filter} if updated_at_filter else {}
+            self.check_mongo_index(collection)
+            # The whole batch is held in memory until upload_to_s3 stages it: the raw CSV needs every
+            # document's keys for its header. THROUGHPUT_BUDGETS only bounds pages, chunks and parts.
+            cursor = []
+            for page in self.iter_mongo_pages(collection, query, controller):
+                cursor.extend(page)
             self.logger.info(f"Extracted {len(cursor)} records from MongoDB")
             return cursor
         except Exception as e:
@@ -68,34 +158,67 @@ class DataExtractor:
             self.logger.error(error_message)
             raise
 
-    def upload_to_s3(self, data):
-        # Save the extracted data as a CSV and upload to S3 for downstream processing
-        self.logger.info("Uploading DataFrame to S3")
-        try:
-            df = pd.DataFrame(data)
-            csv_buffer = io.BytesIO()
-            df.to_csv(csv_buffer, index=False)
-            csv_buffer.seek(0)
+    def iter_frame_chunks(self, data, columns, controller):
+        # Cut the extracted documents into frames of the controller's current chunk_rows
+        start = 0
+        while start < len(data):
+            end = start + controller.chunk_rows
+            yield pd.DataFrame(data[start:end], columns=columns)
+            start = end
 
-            s3 = boto3.client(
-                "s3",
-                aws_access_key_id=self.aws_access_key_id,
-                aws_secret_access_key=self.aws_secret_access_key,
-            )
-            s3.upload_fileobj(csv_buffer, self.s3_bucket_name, "data/delivery_attempts.csv")
-            self.logger.info("Upload to S3 successful")
+    def upload_to_s3(self, data, s3_object_key=RAW_S3_OBJECT_KEY, controller=None):
+        # Stage the extracted data for downstream processing, in chunks sized by the controller
+        self.logger.info(f"Uploading DataFrame to {self.staging_storage.describe(s3_object_key)}")
+        controller = controller or self.build_throughput_controller()
+        try:
+            if not data:
+                self.staging_storage.write_frame(s3_object_key, pd.DataFrame(data))
+            else:
+                # Every chunk needs the same columns in the same order for the CSV to line up
+                columns = list(dict.fromkeys(key for doc in data for key in doc))
+                self.staging_storage.write_frame_chunks(
+                    s3_object_key,
+                    self.iter_frame_chunks(data, columns, controller),
+                    lambda: controller.part_size,
+                    controller.record_write,
+                )
+            self.logger.info("Upload to staging successful")
         except Exception as e:
-            error_message = f"{self.msg_text}: Error uploading to S3: {e}"
+            error_message = f"{self.msg_text}: Error uploading to staging: {e}"
             self.logger.error(error_message)
             raise
 
-    def run_extraction(self):
+    def run_extraction(self, run_id=None):
         # Main entry point for the extraction phase
+        recorder = RunRecorder("extract", run_id)
+        status = "failed"
+        self.run_metrics = {}
         try:
-            extracted_date = self.extract_last_updated_date()
-            mongo_data = self.extract_mongo_data(extracted_date)
-            self.upload_to_s3(mongo_data)
+            extracted_date = recorder.call("extract_last_updated_date", self.extract_last_updated_date)
+            controller = self.build_throughput_controller()
+            mongo_data = recorder.call("extract_mongo_data", self.extract_mongo_data, extracted_date, controller=controller)
+            recorder.batch_rows = len(mongo_data)
+            recorder.call("upload_to_s3", self.upload_to_s3, mongo_data, controller=controller)
+            self.run_metrics = controller.metrics()
+            self.logger.info(f"Extraction metrics: {self.run_metrics}")
             self.logger.info("Extraction phase completed successfully")
+            status = "success"
         except Exception as e:
             self.logger.error(f"{self.msg_text}: Extraction failed: {e}")
+            raise
+        finally:
+            if self.performance_history:
+                self.performance_history.append_run(recorder, status, self.run_metrics)
+
+    def run_window_extraction(self, window_start, window_end, s3_object_key):
+        # Extract a fixed [window_start, window_end) range without reading the watermark
+        self.logger.info(f"Starting window extraction for [{window_start}, {window_end})")
+        try:
+            controller = self.build_throughput_controller()
+            mongo_data = self.extract_mongo_data(window_start, window_end, controller)
+            self.upload_to_s3(mongo_data, s3_object_key, controller)
+            self.logger.info("Window extraction completed successfully")
+            return len(mongo_data)
+        except Exception as e:
+            self.logger.error(f"{self.msg_text}: Window extraction failed: {e}")
             raise
\ No newline at end of file
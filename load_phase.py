@@ -1,9 +1,12 @@
+import json
 import psycopg2
-import boto3
+from staging_storage import S3StagingStorage
+from performance_log import RunRecorder
 from datetime import timedelta, date
+from transform_phase import ROW_HASH_INDEX_KEY, PENDING_ROW_HASH_INDEX_KEY
 
 class DataLoader:
-    def __init__(self, logger, REDSHIFT_PARAMS, S3_BUCKET_NAME, S3_PARTITION_PREFIX, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, REGION_NAME, MSG_TEXT, ETL_JOB_NAME, REDSHIFT_TABLE, DELIVERIES_ATTEMPTS_COLUMNS):
+    def __init__(self, logger, REDSHIFT_PARAMS, S3_BUCKET_NAME, S3_PARTITION_PREFIX, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, REGION_NAME, MSG_TEXT, ETL_JOB_NAME, REDSHIFT_TABLE, DELIVERIES_ATTEMPTS_COLUMNS, DATA_TYPES, REDSHIFT_TABLE_DESIGN, REDSHIFT_COPY_OPTIONS, staging_storage=None, performance_history=None, target_warehouse="redshift"):
         # Store all config and credentials needed for loading
         self.logger = logger
         self.redshift_params = REDSHIFT_PARAMS
@@ -16,7 +19,168 @@ class DataLoader:
         self.etl_job_name = ETL_JOB_NAME
         self.redshift_table = REDSHIFT_TABLE
         self.deliveries_attempts_columns = DELIVERIES_ATTEMPTS_COLUMNS
-        self.s3_client = None
+        self.data_types = DATA_TYPES
+        self.table_design = REDSHIFT_TABLE_DESIGN
+        self.copy_options = REDSHIFT_COPY_OPTIONS
+        self.staging_storage = staging_storage or S3StagingStorage(
+            S3_BUCKET_NAME, AWS_ACCESS_KEY_ID, AWS_SECRET_ACCESS_KEY, REGION_NAME
+        )
+        self.performance_history = performance_history
+        if target_warehouse not in ("redshift", "postgres"):
+            raise ValueError(f"Unknown target warehouse: {target_warehouse}")
+        if target_warehouse == "redshift" and self.staging_storage.s3_uri("") is None:
+            raise ValueError("Redshift COPY reads from S3, local staging can only load into Postgres")
+        self.target_warehouse = target_warehouse
+        self.run_metrics = {}
+
+    def split_table_name(self):
+        # Split "schema.table" into its parts, defaulting to the public schema
+        if "." in self.redshift_table:
+            schema, table = self.redshift_table.split(".", 1)
+        else:
+            schema, table = "public", self.redshift_table
+        return schema, table
+
+    def map_column_type(self, column_name):
+        # Translate a pandas dtype from DATA_TYPES into the Redshift column type
+        type_overrides = self.table_design.get("type_overrides", {})
+        if column_name in type_overrides:
+            return type_overrides[column_name]
+        dtype = self.data_types.get(column_name, "str")
+        if dtype is bool or dtype == "bool":
+            return "BOOLEAN"
+        if dtype == "int64":
+            return "BIGINT"
+        if dtype == "int":
+            return "INTEGER"
+        if str(dtype).startswith("datetime64"):
+            return "TIMESTAMP"
+        varchar_length = self.table_design["varchar_lengths"].get(column_name, self.table_design["default_varchar_length"])
+        return f"VARCHAR({varchar_length})"
+
+    def loads_into_redshift(self):
+        # Postgres (TARGET_WAREHOUSE=postgres) gets the staged files through COPY FROM STDIN, and the
+        # Redshift-only features (dist/sort keys, svv_table_info, VACUUM DELETE ONLY) are skipped
+        return self.target_warehouse == "redshift"
+
+    def build_create_table_ddl(self, physical_design=True):
+        # Generate the target table DDL from the column list, with DISTKEY on id and SORTKEY on updatedAt
+        column_definitions = ",\n            ".join(
+            f"{column_name} {self.map_column_type(column_name)}" for column_name in self.deliveries_attempts_columns
+        )
+        ddl = f"""
+        CREATE TABLE IF NOT EXISTS {self.redshift_table} (
+            {column_definitions}
+        )"""
+        if not physical_design:
+            return ddl + ";"
+        return ddl + f"""
+        DISTSTYLE KEY
+        DISTKEY ({self.table_design["distkey"]})
+        SORTKEY ({self.table_design["sortkey"]});
+        """
+
+    def extract_table_info(self):
+        # Read distribution, sort key and deleted-row stats for the target table from svv_table_info
+        schema, table = self.split_table_name()
+        with psycopg2.connect(**self.redshift_params) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(
+                    """
+                    SELECT diststyle, sortkey1, tbl_rows, estimated_visible_rows, unsorted
+                    FROM svv_table_info
+                    WHERE "schema" = %s AND "table" = %s
+                    """,
+                    (schema, table),
+                )
+                result = cursor.fetchone()
+        if result is None:
+            return None
+        diststyle, sortkey1, tbl_rows, estimated_visible_rows, unsorted = result
+        return {
+            "diststyle": diststyle,
+            "sortkey1": sortkey1,
+            "tbl_rows": tbl_rows or 0,
+            "estimated_visible_rows": estimated_visible_rows or 0,
+            "unsorted": unsorted,
+        }
+
+    def ensure_target_table(self):
+        # Create the target table if missing and check that its dist/sort keys match the design
+        self.logger.info(f"Ensuring target table design for {self.redshift_table}")
+        try:
+            conn = psycopg2.connect(**self.redshift_params)
+            cur = conn.cursor()
+            cur.execute(self.build_create_table_ddl(physical_design=self.loads_into_redshift()))
+            conn.commit()
+            cur.close()
+            conn.close()
+            if not self.loads_into_redshift():
+                return
+
+            # svv_table_info only lists tables that hold data, so a fresh table has nothing to validate
+            table_info = self.extract_table_info()
+            if table_info is None:
+                return
+            distkey = self.table_design["distkey"]
+            sortkey = self.table_design["sortkey"]
+            alter_statements = []
+            if (table_info["diststyle"] or "").lower() != f"key({distkey.lower()})":
+                self.logger.warning(
+                    f"{self.redshift_table} has diststyle {table_info['diststyle']}, expected KEY({distkey})"
+                )
+                alter_statements.append(f"ALTER TABLE {self.redshift_table} ALTER DISTKEY {distkey}")
+            if (table_info["sortkey1"] or "").lower() != sortkey.lower():
+                self.logger.warning(
+                    f"{self.redshift_table} has sortkey {table_info['sortkey1']}, expected {sortkey}"
+                )
+                alter_statements.append(f"ALTER TABLE {self.redshift_table} ALTER SORTKEY ({sortkey})")
+            if alter_statements and self.table_design.get("enforce"):
+                conn = psycopg2.connect(**self.redshift_params)
+                conn.autocommit = True
+                cur = conn.cursor()
+                for alter_statement in alter_statements:
+                    self.logger.info(f"Running: {alter_statement}")
+                    cur.execute(alter_statement)
+                cur.close()
+                conn.close()
+        except Exception as e:
+            self.logger.error(f"{self.msg_text}: Redshift table design Error: {str(e)}")
+            raise
+
+    def maintain_table(self):
+        # Reclaim ghost rows left by DELETEs once they pass the configured share of the table.
+        # Returns the deleted rows ratio (None when unknown) and whether VACUUM ran.
+        maintenance = {"deleted_ratio": None, "vacuum_ran": False}
+        if not self.loads_into_redshift():
+            self.logger.info("Skipping table maintenance, Postgres autovacuum handles deleted rows")
+            return maintenance
+        self.logger.info(f"Checking deleted rows ratio for {self.redshift_table}")
+        try:
+            table_info = self.extract_table_info()
+            if table_info is None or table_info["tbl_rows"] == 0:
+                return maintenance
+            deleted_ratio = 1 - table_info["estimated_visible_rows"] / table_info["tbl_rows"]
+            threshold = self.table_design["vacuum_deleted_ratio_threshold"]
+            self.logger.info(
+                f"Deleted rows ratio: {deleted_ratio:.2%} (threshold {threshold:.2%}), unsorted: {table_info['unsorted']}%"
+            )
+            if deleted_ratio >= threshold:
+                # VACUUM cannot run inside a transaction block
+                conn = psycopg2.connect(**self.redshift_params)
+                conn.autocommit = True
+                cur = conn.cursor()
+                self.logger.info(f"Running VACUUM DELETE ONLY and ANALYZE on {self.redshift_table}")
+                cur.execute(f"VACUUM DELETE ONLY {self.redshift_table};")
+                cur.execute(f"ANALYZE {self.redshift_table};")
+                cur.close()
+                conn.close()
+                maintenance["vacuum_ran"] = True
+            maintenance["deleted_ratio"] = deleted_ratio
+            return maintenance
+        except Exception as e:
+            self.logger.error(f"{self.msg_text}: Redshift table maintenance Error: {str(e)}")
+            raise
 
     def update_latest_updated_at(self, job_name, last_updated_at):
         # Update the ETL job metadata in Redshift with the latest processed date
@@ -39,45 +203,226 @@ class DataLoader:
             self.logger.error(f"{self.msg_text}: update last_updated_at Error: {str(e)}")
             raise
 
-    def copy_from_s3_to_redshift(self, s3_object_key):
-        # Use Redshift's COPY command to load the CSV from S3 into the target table
+    def build_copy_command(self, source_uri, use_manifest=False, target_table=None):
+        # Build the Redshift COPY from REDSHIFT_COPY_OPTIONS; the column list follows DELIVERIES_ATTEMPTS_COLUMNS
+        file_format = self.copy_options.get("format", "CSV").upper()
+        if file_format != "CSV":
+            # The transform only stages CSV, any other format would not match the files being loaded
+            raise ValueError(f"Unsupported COPY format: {file_format}")
+        column_list_str = ', '.join(self.deliveries_attempts_columns)
+        clauses = [
+            f"COPY {target_table or self.redshift_table} ({column_list_str})",
+            f"FROM '{source_uri}'",
+            f"ACCESS_KEY_ID '{self.aws_access_key_id}'",
+            f"SECRET_ACCESS_KEY '{self.aws_secret_access_key}'",
+            f"FORMAT AS {file_format}",
+            "IGNOREHEADER 1",
+        ]
+        if use_manifest:
+            clauses.append("MANIFEST")
+        if self.copy_options.get("timeformat"):
+            clauses.append(f"TIMEFORMAT '{self.copy_options['timeformat']}'")
+        if self.copy_options.get("maxerror") is not None:
+            clauses.append(f"MAXERROR {int(self.copy_options['maxerror'])}")
+        # None leaves Redshift's own default in place
+        for option in ("compupdate", "statupdate"):
+            if self.copy_options.get(option) is not None:
+                clauses.append(f"{option.upper()} {'ON' if self.copy_options[option] else 'OFF'}")
+        return "\n".join(clauses)
+
+    def write_copy_manifest(self, s3_object_keys):
+        # A manifest names the exact files to load, so a multi-file COPY cannot pick up stray objects
+        # that share the key prefix; Redshift spreads the listed files across the cluster's slices
+        manifest_key = f"{s3_object_keys[0]}.manifest"
+        entries = [{"url": self.staging_storage.s3_uri(key), "mandatory": True} for key in s3_object_keys]
+        self.staging_storage.write_bytes(manifest_key, json.dumps({"entries": entries}))
+        return manifest_key
+
+    def extract_copy_load_errors(self, cur):
+        # Rows the last COPY of this session rejected, as recorded in stl_load_errors
+        cur.execute(
+            """
+            SELECT TRIM(filename), line_number, TRIM(colname), err_code, TRIM(err_reason)
+            FROM stl_load_errors
+            WHERE query = pg_last_copy_id()
+            ORDER BY starttime, line_number
+            LIMIT %s
+            """,
+            (self.copy_options.get("max_reported_errors", 100),),
+        )
+        return [
+            {"file": file, "line_number": line_number, "column": column, "err_code": err_code, "err_reason": err_reason}
+            for file, line_number, column, err_code, err_reason in cur.fetchall()
+        ]
+
+    def extract_copy_load_report(self, cur):
+        # Rows, files and bytes the last COPY of this session loaded, per slice, plus rejected rows
+        cur.execute("SELECT pg_last_copy_id(), pg_last_copy_count()")
+        query_id, rows_loaded = cur.fetchone()
+        cur.execute(
+            """
+            SELECT slice, TRIM(filename), lines_scanned, errors
+            FROM stl_load_commits
+            WHERE query = %s
+            ORDER BY slice, filename
+            """,
+            (query_id,),
+        )
+        files = [
+            {"slice": slice_id, "file": file, "lines_scanned": lines_scanned, "errors": errors}
+            for slice_id, file, lines_scanned, errors in cur.fetchall()
+        ]
+        cur.execute(
+            """
+            SELECT slice, COUNT(*), SUM(lines), SUM(bytes)
+            FROM stl_file_scan
+            WHERE query = %s
+            GROUP BY slice
+            ORDER BY slice
+            """,
+            (query_id,),
+        )
+        slices = [
+            {"slice": slice_id, "files": file_count, "lines": lines, "bytes": nbytes}
+            for slice_id, file_count, lines, nbytes in cur.fetchall()
+        ]
+        return {
+            "query_id": query_id,
+            "rows_loaded": rows_loaded,
+            "files": files,
+            "slices": slices,
+            "errors": self.extract_copy_load_errors(cur),
+        }
+
+    def copy_into_table(self, cur, s3_object_keys, target_table):
+        # Run the COPY of the staged file(s) into target_table on the given cursor and return the load report
+        if not self.loads_into_redshift():
+            # Local staging: stream the files through the client, e.g. into a Postgres used for development.
+            # Postgres has no slices or load system tables, the report only carries per-file row counts.
+            column_list_str = ', '.join(self.deliveries_attempts_columns)
+            files = []
+            for key in s3_object_keys:
+                with self.staging_storage.open_buffer(key) as source:
+                    cur.copy_expert(
+                        f"COPY {target_table} ({column_list_str}) FROM STDIN WITH (FORMAT csv, HEADER true)", source
+                    )
+                files.append({"file": self.staging_storage.describe(key), "lines_scanned": cur.rowcount})
+            return {
+                "query_id": None,
+                "rows_loaded": sum(file["lines_scanned"] for file in files),
+                "files": files,
+                "slices": [],
+                "errors": [],
+            }
+        use_manifest = len(s3_object_keys) > 1 or self.copy_options.get("manifest", False)
+        manifest_key = self.write_copy_manifest(s3_object_keys) if use_manifest else None
+        try:
+            source_uri = self.staging_storage.s3_uri(manifest_key or s3_object_keys[0])
+            cur.execute(self.build_copy_command(source_uri, use_manifest, target_table))
+            return self.extract_copy_load_report(cur)
+        finally:
+            if manifest_key:
+                self.staging_storage.delete(manifest_key)
+
+    def replace_rows_from_staging_table(self, cur, staging_table):
+        # Swap in the staged rows: delete the ids being reloaded and insert their new versions.
+        # The LOCK makes concurrent backfill windows take turns instead of failing on a
+        # serializable isolation violation; it is held only for this short transaction.
+        column_list_str = ', '.join(self.deliveries_attempts_columns)
+        cur.execute(f"LOCK {self.redshift_table}")
+        cur.execute(f"DELETE FROM {self.redshift_table} USING {staging_table} WHERE {self.redshift_table}.id = {staging_table}.id")
+        rows_replaced = cur.rowcount
+        cur.execute(f"INSERT INTO {self.redshift_table} ({column_list_str}) SELECT {column_list_str} FROM {staging_table}")
+        cur.execute(f"DROP TABLE {staging_table}")
+        return rows_replaced
+
+    def copy_from_s3_to_redshift(self, s3_object_key, replace_existing_ids=False):
+        # Load the staged CSV file(s) into the target table and return a load report.
+        # With replace_existing_ids the files are copied into a temp table first, then the target
+        # rows with the same ids are deleted and the new versions inserted in one transaction, so
+        # the target table never misses rows, even when the COPY fails.
         self.logger.info("Copying data from S3 to Redshift")
+        s3_object_keys = [s3_object_key] if isinstance(s3_object_key, str) else list(s3_object_key)
+        conn = None
         try:
-            column_list_str = ', '.join(self.deliveries_attempts_columns)
             conn = psycopg2.connect(**self.redshift_params)
             cur = conn.cursor()
-            copy_query = f"""
-            COPY {self.redshift_table} ({column_list_str})
-            FROM 's3://{self.s3_bucket_name}/{s3_object_key}'
-            ACCESS_KEY_ID '{self.aws_access_key_id}'
-            SECRET_ACCESS_KEY '{self.aws_secret_access_key}'
-            CSV
-            IGNOREHEADER 1
-            """
-            cur.execute(copy_query)
+            if replace_existing_ids:
+                _, table = self.split_table_name()
+                staging_table = f"{table}_copy_staging"
+                cur.execute(f"CREATE TEMP TABLE {staging_table} (LIKE {self.redshift_table})")
+                load_report = self.copy_into_table(cur, s3_object_keys, staging_table)
+                # Temp tables live for the session, so the COPY can commit before the target is touched
+                conn.commit()
+                load_report["rows_replaced"] = self.replace_rows_from_staging_table(cur, staging_table)
+            else:
+                load_report = self.copy_into_table(cur, s3_object_keys, self.redshift_table)
             conn.commit()
             cur.close()
             conn.close()
+            self.logger.info(
+                f"COPY loaded {load_report['rows_loaded']} rows from {len(s3_object_keys)} file(s) "
+                f"across {len(load_report['slices'])} slice(s), {len(load_report['errors'])} row(s) rejected"
+            )
+            for error in load_report["errors"]:
+                self.logger.warning(f"COPY rejected row: {error}")
+            return load_report
         except Exception as e:
             self.logger.error(f"{self.msg_text}: Redshift copy Error: {str(e)}")
+            if conn is not None and self.loads_into_redshift():
+                # A failed COPY leaves the reason per row in stl_load_errors, surface it before raising
+                try:
+                    conn.rollback()
+                    cur = conn.cursor()
+                    for error in self.extract_copy_load_errors(cur):
+                        self.logger.error(f"COPY load error: {error}")
+                except Exception as report_error:
+                    self.logger.warning(f"Could not read stl_load_errors: {report_error}")
             raise
+        finally:
+            if conn is not None and not conn.closed:
+                conn.close()
 
     def cleanup_s3(self, s3_object_key):
-        # Delete the processed file from S3 to keep the bucket clean
-        self.logger.info("Cleaning up S3")
+        # Delete the processed file(s) from staging to keep the bucket clean
+        s3_object_keys = [s3_object_key] if isinstance(s3_object_key, str) else list(s3_object_key)
         try:
-            if self.s3_client is None:
-                self.s3_client = boto3.client(
-                    "s3",
-                    aws_access_key_id=self.aws_access_key_id,
-                    aws_secret_access_key=self.aws_secret_access_key,
-                    region_name=self.region_name,
-                )
-            self.s3_client.delete_object(Bucket=self.s3_bucket_name, Key=s3_object_key)
+            for key in s3_object_keys:
+                self.logger.info(f"Cleaning up {self.staging_storage.describe(key)}")
+                self.staging_storage.delete(key)
         except Exception as e:
             self.logger.error(f"{self.msg_text}: S3 cleanup Error: {str(e)}")
             raise
-        
+
+    def supports_change_detection(self):
+        # The row hash index assumes every staged row was loaded, which only holds while COPY rejects nothing
+        return not self.copy_options.get("maxerror")
+
+    def promote_row_hash_index(self):
+        # Make the transform's pending row hash index current now that its rows are in Redshift
+        self.logger.info("Promoting pending row hash index")
+        try:
+            if not self.staging_storage.exists(PENDING_ROW_HASH_INDEX_KEY):
+                self.logger.info("No pending row hash index to promote")
+                return
+            if not self.supports_change_detection():
+                # Rows COPY rejected would stay in the index and be dropped as unchanged from then on
+                self.logger.warning("MAXERROR allows rejected rows, discarding the pending row hash index")
+                self.staging_storage.delete(PENDING_ROW_HASH_INDEX_KEY)
+                return
+            self.staging_storage.copy(PENDING_ROW_HASH_INDEX_KEY, ROW_HASH_INDEX_KEY)
+            self.staging_storage.delete(PENDING_ROW_HASH_INDEX_KEY)
+        except Exception as e:
+            self.logger.error(f"{self.msg_text}: row hash index promotion Error: {str(e)}")
+            raise
+
+    def count_table_rows(self):
+        # Current number of rows in the target table
+        with psycopg2.connect(**self.redshift_params) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(f"SELECT COUNT(*) FROM {self.redshift_table}")
+                return cursor.fetchone()[0]
+
     def delete_duplicates_from_redshift(self):
         # Remove duplicate records from the Redshift table if needed
         self.logger.info("Deleting duplicates from Redshift")
@@ -94,22 +439,48 @@ class DataLoader:
             );
             """
             cur.execute(delete_query)
+            deleted_rows = cur.rowcount
             conn.commit()
             cur.close()
             conn.close()
+            self.logger.info(f"Deleted {deleted_rows} duplicate rows from Redshift")
+            return deleted_rows
 
         except Exception as e:
             self.logger.error(f"{self.msg_text}: Redshift delete duplicates Error: {str(e)}")
             raise
 
-    def run_loading(self, last_updated_at, s3_object_key):
+    def run_loading(self, last_updated_at, s3_object_key, update_watermark=True, delete_duplicates=True, replace_existing_ids=False, run_id=None):
         # Main entry point for the loading phase
         self.logger.info("Starting load phase")
+        self.run_metrics = {}
+        recorder = RunRecorder("load", run_id)
+        step = recorder.call
+        status = "failed"
         try:
-            self.update_latest_updated_at(self.etl_job_name, last_updated_at)
-            self.copy_from_s3_to_redshift(s3_object_key)
-            self.cleanup_s3(s3_object_key)
-            self.delete_duplicates_from_redshift()
+            step("ensure_target_table", self.ensure_target_table)
+            load_report = step("copy_from_s3_to_redshift", self.copy_from_s3_to_redshift, s3_object_key, replace_existing_ids)
+            recorder.annotate_rows(load_report["rows_loaded"])
+            recorder.batch_rows = load_report["rows_loaded"]
+            self.run_metrics["rows_copied"] = load_report["rows_loaded"]
+            self.run_metrics["copy_load_report"] = load_report
+            if update_watermark:
+                step("promote_row_hash_index", self.promote_row_hash_index)
+                # Only advanced once the batch and its hash index are in place, so a failed COPY is extracted again.
+                # An empty or fully quarantined batch has no watermark, keep the previous one.
+                if last_updated_at is not None:
+                    step("update_latest_updated_at", self.update_latest_updated_at, self.etl_job_name, last_updated_at)
+            step("cleanup_s3", self.cleanup_s3, s3_object_key)
+            if delete_duplicates:
+                self.run_metrics["rows_deduplicated"] = step("delete_duplicates_from_redshift", self.delete_duplicates_from_redshift)
+                self.run_metrics.update(step("maintain_table", self.maintain_table))
+                # Both scan the whole table, so they are costed per table row rather than per loaded row
+                self.run_metrics["table_rows"] = self.count_table_rows()
+                recorder.annotate_rows(self.run_metrics["table_rows"], "delete_duplicates_from_redshift", "maintain_table")
+            status = "success"
         except Exception as e:
             self.logger.error(f"{self.msg_text}: Load phase failed: {str(e)}")
-            raise
\ No newline at end of file
+            raise
+        finally:
+            if self.performance_history:
+                self.performance_history.append_run(recorder, status, self.run_metrics)
@@ -0,0 +1,196 @@
+import argparse
+import json
+import sqlite3
+import statistics
+import time
+import uuid
+from datetime import datetime
+
+
+class RunRecorder:
+    # Collects per-step timings and row counts for one run of one phase
+    def __init__(self, phase, run_id=None):
+        self.phase = phase
+        self.run_id = run_id or f"manual__{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}_{uuid.uuid4().hex[:8]}"
+        self.started_at = datetime.utcnow()
+        self.steps = []
+        # Rows in the batch this run processed; steps that do not report rows are costed against it
+        self.batch_rows = None
+
+    def call(self, step_name, func, *args, **kwargs):
+        # Run one pipeline step and record how long it took and, for frames and document lists,
+        # how many rows it produced. Anything else (counts, keys, reports) is set with annotate_rows.
+        started = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds = time.perf_counter() - started
+        if hasattr(result, "shape"):
+            rows = len(result)
+        elif isinstance(result, list) and not any(isinstance(item, str) for item in result[:1]):
+            rows = len(result)
+        else:
+            rows = None
+        self.steps.append({"step": step_name, "seconds": seconds, "rows": rows})
+        return result
+
+    def annotate_rows(self, rows, *step_names):
+        # Set the row count of the named steps, the last step by default
+        for step in self.steps:
+            if step["step"] in step_names or (not step_names and step is self.steps[-1]):
+                step["rows"] = rows
+
+
+class PerformanceHistory:
+    # Local SQLite history of every run's step timings and run metrics
+    def __init__(self, path, logger):
+        self.path = path
+        self.logger = logger
+
+    def connect(self):
+        conn = sqlite3.connect(self.path)
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS step_timings (
+                run_id TEXT,
+                phase TEXT,
+                step TEXT,
+                started_at TEXT,
+                status TEXT,
+                seconds REAL,
+                rows INTEGER,
+                batch_rows INTEGER
+            )
+            """
+        )
+        # Histories written before batch_rows existed get the column added in place
+        if "batch_rows" not in [column[1] for column in conn.execute("PRAGMA table_info(step_timings)")]:
+            conn.execute("ALTER TABLE step_timings ADD COLUMN batch_rows INTEGER")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS run_metrics (
+                run_id TEXT,
+                phase TEXT,
+                started_at TEXT,
+                status TEXT,
+                metrics TEXT
+            )
+            """
+        )
+        return conn
+
+    def append_run(self, recorder, status, run_metrics=None):
+        # Persist one phase run; a broken history file must never fail the ETL itself
+        try:
+            conn = self.connect()
+            started_at = recorder.started_at.isoformat()
+            with conn:
+                conn.executemany(
+                    """
+                    INSERT INTO step_timings (run_id, phase, step, started_at, status, seconds, rows, batch_rows)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    [
+                        (
+                            recorder.run_id, recorder.phase, step["step"], started_at, status,
+                            step["seconds"], step["rows"], recorder.batch_rows,
+                        )
+                        for step in recorder.steps
+                    ],
+                )
+                conn.execute(
+                    "INSERT INTO run_metrics VALUES (?, ?, ?, ?, ?)",
+                    (recorder.run_id, recorder.phase, started_at, status, json.dumps(run_metrics or {}, default=str)),
+                )
+            conn.close()
+        except Exception as e:
+            self.logger.warning(f"Could not append run {recorder.run_id} to performance history: {e}")
+
+    def load_successful_runs(self, phase):
+        # {run_id: {step: (seconds, rows, batch_rows)}} for successful runs of a phase, oldest first
+        conn = self.connect()
+        rows = conn.execute(
+            """
+            SELECT run_id, step, seconds, rows, batch_rows
+            FROM step_timings
+            WHERE phase = ? AND status = 'success'
+            ORDER BY started_at, rowid
+            """,
+            (phase,),
+        ).fetchall()
+        conn.close()
+        runs = {}
+        for run_id, step, seconds, step_rows, batch_rows in rows:
+            runs.setdefault(run_id, {})[step] = (seconds, step_rows, batch_rows)
+        return runs
+
+    def regression_report(self, baseline_runs=10, threshold=1.5, min_seconds=1.0):
+        # Compare the latest run of every phase with the median of the runs before it, per step,
+        # using seconds per row so a bigger batch on its own is not flagged as a regression
+        report = []
+        for phase in ("extract", "transform", "load"):
+            runs = self.load_successful_runs(phase)
+            if len(runs) < 2:
+                continue
+            run_ids = list(runs)
+            latest_id = run_ids[-1]
+            baseline_ids = run_ids[-baseline_runs - 1:-1]
+            latest_cost = cost_per_row(runs[latest_id])
+            baseline_costs = [cost_per_row(runs[run_id]) for run_id in baseline_ids]
+            for step, (latest_seconds, latest_per_row) in latest_cost.items():
+                history = [costs[step][1] for costs in baseline_costs if step in costs and costs[step][1]]
+                if not history or not latest_per_row:
+                    continue
+                baseline_per_row = statistics.median(history)
+                ratio = latest_per_row / baseline_per_row if baseline_per_row else None
+                report.append({
+                    "phase": phase,
+                    "step": step,
+                    "run_id": latest_id,
+                    "seconds": latest_seconds,
+                    "seconds_per_row": latest_per_row,
+                    "baseline_seconds_per_row": baseline_per_row,
+                    "ratio": ratio,
+                    # Tiny steps swing wildly in relative terms, only flag ones that cost real time
+                    "regressed": bool(ratio and ratio >= threshold and latest_seconds >= min_seconds),
+                })
+        return report
+
+
+def cost_per_row(run_steps):
+    # Seconds per row of every step. Steps that report no rows of their own (uploads, metadata
+    # updates) are divided by the rows in the run's batch.
+    costs = {}
+    for step, (seconds, rows, batch_rows) in run_steps.items():
+        denominator = rows or batch_rows
+        costs[step] = (seconds, seconds / denominator if denominator else None)
+    return costs
+
+
+def main():
+    # Command line report: python performance_log.py --baseline-runs 10 --threshold 1.5
+    from config import PERFORMANCE_HISTORY_PATH, logger
+
+    parser = argparse.ArgumentParser(description="Flag steps whose cost per row regressed in the latest run")
+    parser.add_argument("--path", default=PERFORMANCE_HISTORY_PATH, help="SQLite performance history file")
+    parser.add_argument("--baseline-runs", type=int, default=10, help="Previous runs in the rolling baseline")
+    parser.add_argument("--threshold", type=float, default=1.5, help="Cost-per-row ratio that counts as a regression")
+    parser.add_argument("--min-seconds", type=float, default=1.0, help="Ignore steps faster than this")
+    args = parser.parse_args()
+
+    history = PerformanceHistory(args.path, logger)
+    report = history.regression_report(args.baseline_runs, args.threshold, args.min_seconds)
+    if not report:
+        print("Not enough successful runs in the history to compare")
+        return
+    for entry in report:
+        flag = "REGRESSED" if entry["regressed"] else "ok"
+        print(
+            f"{flag:9} {entry['phase']:9} {entry['step']:45} {entry['seconds']:9.2f}s "
+            f"{entry['seconds_per_row'] * 1000:9.4f}ms/row vs {entry['baseline_seconds_per_row'] * 1000:9.4f}ms/row "
+            f"(x{entry['ratio']:.2f})"
+        )
+    if any(entry["regressed"] for entry in report):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
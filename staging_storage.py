@@ -0,0 +1,189 @@
+import io
+import os
+import tempfile
+import time
+import boto3
+import pandas as pd
+import pyarrow as pa
+from botocore.exceptions import ClientError
+
+
+class S3StagingStorage:
+    # Staging area in an S3 bucket, the backend Redshift COPY reads from in production
+    def __init__(self, s3_bucket_name, aws_access_key_id, aws_secret_access_key, region_name):
+        self.s3_bucket_name = s3_bucket_name
+        self.s3_client = boto3.client(
+            "s3",
+            aws_access_key_id=aws_access_key_id,
+            aws_secret_access_key=aws_secret_access_key,
+            region_name=region_name,
+        )
+
+    def describe(self, key):
+        return f"s3://{self.s3_bucket_name}/{key}"
+
+    def s3_uri(self, key):
+        return f"s3://{self.s3_bucket_name}/{key}"
+
+    def write_bytes(self, key, body):
+        self.s3_client.put_object(Bucket=self.s3_bucket_name, Key=key, Body=body)
+
+    def open_buffer(self, key):
+        # Download the whole object into memory and hand back a file-like buffer
+        buffer = io.BytesIO()
+        self.s3_client.download_fileobj(self.s3_bucket_name, key, buffer)
+        buffer.seek(0)
+        return buffer
+
+    def write_frame(self, key, df):
+        # Frames are staged as CSV in S3, the format the rest of the pipeline and COPY understand
+        csv_buffer = io.BytesIO()
+        df.to_csv(csv_buffer, index=False)
+        csv_buffer.seek(0)
+        self.s3_client.upload_fileobj(csv_buffer, self.s3_bucket_name, key)
+
+    def read_frame(self, key):
+        with self.open_buffer(key) as source:
+            return pd.read_csv(source)
+
+    def write_frame_chunks(self, key, frames, part_size, on_part_written=None):
+        # Stream frames into one CSV object with a multipart upload. Encoded chunks are cut into parts of
+        # exactly part_size bytes, asked again before every part so a throughput controller can resize
+        # parts mid-upload; only the last part is smaller.
+        upload_id = self.s3_client.create_multipart_upload(Bucket=self.s3_bucket_name, Key=key)["UploadId"]
+        parts = []
+        csv_buffer = io.BytesIO()
+
+        def upload_part(body):
+            started = time.perf_counter()
+            response = self.s3_client.upload_part(
+                Bucket=self.s3_bucket_name, Key=key, UploadId=upload_id, PartNumber=len(parts) + 1, Body=body
+            )
+            parts.append({"ETag": response["ETag"], "PartNumber": len(parts) + 1})
+            if on_part_written:
+                on_part_written(len(body), time.perf_counter() - started)
+
+        try:
+            for index, df in enumerate(frames):
+                df.to_csv(csv_buffer, index=False, header=index == 0)
+                size = part_size()
+                if csv_buffer.tell() < size:
+                    continue
+                pending = csv_buffer.getvalue()
+                offset = 0
+                while len(pending) - offset >= size:
+                    upload_part(pending[offset:offset + size])
+                    offset += size
+                    size = part_size()
+                csv_buffer = io.BytesIO()
+                csv_buffer.write(pending[offset:])
+            if csv_buffer.tell() or not parts:
+                upload_part(csv_buffer.getvalue())
+            self.s3_client.complete_multipart_upload(
+                Bucket=self.s3_bucket_name, Key=key, UploadId=upload_id, MultipartUpload={"Parts": parts}
+            )
+        except Exception:
+            self.s3_client.abort_multipart_upload(Bucket=self.s3_bucket_name, Key=key, UploadId=upload_id)
+            raise
+
+    def exists(self, key):
+        try:
+            self.s3_client.head_object(Bucket=self.s3_bucket_name, Key=key)
+            return True
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return False
+            raise
+
+    def copy(self, source_key, destination_key):
+        self.s3_client.copy_object(
+            Bucket=self.s3_bucket_name,
+            Key=destination_key,
+            CopySource={"Bucket": self.s3_bucket_name, "Key": source_key},
+        )
+
+    def delete(self, key):
+        self.s3_client.delete_object(Bucket=self.s3_bucket_name, Key=key)
+
+
+class LocalStagingStorage:
+    # Staging area on local disk for development and single-node runs. Frames are written as the
+    # same CSV the S3 backend stages, so both backends give the transform identical input. Files are
+    # memory-mapped on read, which saves the network hop and the in-memory download of the S3 backend;
+    # the CSV still has to be parsed, so this is not a zero-copy Arrow read.
+    def __init__(self, staging_dir):
+        self.staging_dir = staging_dir
+
+    def path_for(self, key):
+        return os.path.join(self.staging_dir, key.lstrip("/"))
+
+    def describe(self, key):
+        return self.path_for(key)
+
+    def s3_uri(self, key):
+        # Local files cannot be read by a Redshift COPY, callers stream them instead
+        return None
+
+    def atomic_write(self, key, write):
+        # Write to a temp file in the same directory and rename, so readers never see half a file
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as sink:
+                write(sink)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def write_bytes(self, key, body):
+        if isinstance(body, str):
+            body = body.encode()
+        self.atomic_write(key, lambda sink: sink.write(body))
+
+    def open_buffer(self, key):
+        # A read-only memory map of the file, file-like for pandas/pyarrow; use it as a context manager to unmap it
+        return pa.memory_map(self.path_for(key), "r")
+
+    def write_frame(self, key, df):
+        self.atomic_write(key, lambda sink: df.to_csv(sink, index=False))
+
+    def write_frame_chunks(self, key, frames, part_size, on_part_written=None):
+        # Append every chunk to one CSV file; part_size only applies to S3 and is ignored here
+        def write(sink):
+            for index, df in enumerate(frames):
+                started = time.perf_counter()
+                position = sink.tell()
+                df.to_csv(sink, index=False, header=index == 0)
+                if on_part_written:
+                    on_part_written(sink.tell() - position, time.perf_counter() - started)
+
+        self.atomic_write(key, write)
+
+    def read_frame(self, key):
+        with self.open_buffer(key) as source:
+            return pd.read_csv(source)
+
+    def exists(self, key):
+        return os.path.exists(self.path_for(key))
+
+    def copy(self, source_key, destination_key):
+        with open(self.path_for(source_key), "rb") as source:
+            body = source.read()
+        self.write_bytes(destination_key, body)
+
+    def delete(self, key):
+        path = self.path_for(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def build_staging_storage(backend, s3_bucket_name, aws_access_key_id, aws_secret_access_key, region_name, local_staging_dir):
+    # Pick the staging backend named in config (STAGING_BACKEND)
+    if backend == "s3":
+        return S3StagingStorage(s3_bucket_name, aws_access_key_id, aws_secret_access_key, region_name)
+    if backend == "local":
+        return LocalStagingStorage(local_staging_dir)
+    raise ValueError(f"Unknown staging backend: {backend}")
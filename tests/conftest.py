@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The pipeline modules live at the repository root and are imported by name
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
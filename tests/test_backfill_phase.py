@@ -0,0 +1,63 @@
+import logging
+from datetime import datetime
+
+import pytest
+
+from backfill_phase import BackfillRunner
+
+
+def make_runner(window_days):
+    return BackfillRunner(None, None, None, {}, "interns.etl_backfill_metadata", "deliveryAttempts", "/", window_days, 1, None, "ETL")
+
+
+def test_windows_cover_the_range_and_clip_the_last_one():
+    windows = make_runner(2).split_into_windows(datetime(2025, 7, 1), datetime(2025, 7, 6))
+    assert windows == [
+        (datetime(2025, 7, 1), datetime(2025, 7, 3)),
+        (datetime(2025, 7, 3), datetime(2025, 7, 5)),
+        (datetime(2025, 7, 5), datetime(2025, 7, 6)),
+    ]
+
+
+def test_empty_range_is_rejected():
+    with pytest.raises(ValueError):
+        make_runner(1).split_into_windows(datetime(2025, 7, 2), datetime(2025, 7, 1))
+
+
+class RecordingPhase:
+    # Stands in for DataTransformer and DataLoader, keeping run_metrics on the instance like they do
+    def __init__(self, created):
+        created.append(self)
+        self.run_metrics = {}
+
+    def run_transformation(self, raw_s3_object_key, s3_object_key, detect_changes=True):
+        self.run_metrics["raw_s3_object_key"] = raw_s3_object_key
+        return None, [s3_object_key]
+
+    def run_loading(self, last_updated_at, s3_object_keys, **kwargs):
+        self.run_metrics["s3_object_keys"] = s3_object_keys
+
+    def cleanup_s3(self, key):
+        pass
+
+
+class WindowExtractor:
+    def run_window_extraction(self, window_start, window_end, s3_object_key):
+        return 1
+
+
+def test_every_window_gets_its_own_transformer_and_loader(monkeypatch):
+    transformers, loaders = [], []
+    runner = BackfillRunner(
+        WindowExtractor(), lambda: RecordingPhase(transformers), lambda: RecordingPhase(loaders),
+        {}, "interns.etl_backfill_metadata", "deliveryAttempts", "/", 1, 2, logging.getLogger("tests"), "ETL",
+    )
+    monkeypatch.setattr(runner, "update_window_status", lambda *args, **kwargs: None)
+    for window in runner.split_into_windows(datetime(2025, 7, 1), datetime(2025, 7, 3)):
+        runner.run_window(*window)
+
+    assert len(transformers) == len(loaders) == 2
+    assert [loader.run_metrics["s3_object_keys"] for loader in loaders] == [
+        ["/backfill/deliveryAttempts/20250701T000000.csv"],
+        ["/backfill/deliveryAttempts/20250702T000000.csv"],
+    ]
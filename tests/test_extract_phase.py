@@ -0,0 +1,33 @@
+import logging
+
+from extract_phase import DataExtractor
+
+
+class IndexedCollection:
+    def __init__(self, indexes):
+        self.indexes = indexes
+
+    def index_information(self):
+        return self.indexes
+
+
+def make_extractor():
+    return DataExtractor(
+        {}, None, "db", "deliveryAttempts", "bucket", None, None, "deliveryAttempts",
+        logging.getLogger("tests"), "ETL", staging_storage=object(),
+    )
+
+
+def test_page_order_index_is_found():
+    collection = IndexedCollection({
+        "_id_": {"key": [("_id", 1)]},
+        "updatedAt_1__id_1": {"key": [("updatedAt", 1), ("_id", 1)]},
+    })
+    assert make_extractor().check_mongo_index(collection)
+
+
+def test_missing_page_order_index_is_reported(caplog):
+    collection = IndexedCollection({"_id_": {"key": [("_id", 1)]}, "updatedAt_1": {"key": [("updatedAt", 1)]}})
+    with caplog.at_level(logging.WARNING):
+        assert not make_extractor().check_mongo_index(collection)
+    assert "createIndex({updatedAt: 1, _id: 1})" in caplog.text
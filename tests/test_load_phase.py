@@ -0,0 +1,340 @@
+import json
+import logging
+
+import pytest
+
+import load_phase
+from config import DELIVERIES_ATTEMPTS_COLUMNS, DATA_TYPES, REDSHIFT_TABLE_DESIGN, REDSHIFT_COPY_OPTIONS
+from load_phase import DataLoader
+from staging_storage import LocalStagingStorage
+from transform_phase import PENDING_ROW_HASH_INDEX_KEY, ROW_HASH_INDEX_KEY
+
+
+class MemoryS3Storage:
+    # In-memory stand-in for S3StagingStorage: keys map to bytes, URIs look like S3
+    def __init__(self):
+        self.objects = {}
+
+    def describe(self, key):
+        return self.s3_uri(key)
+
+    def s3_uri(self, key):
+        return f"s3://bucket/{key}"
+
+    def write_bytes(self, key, body):
+        self.objects[key] = body.encode() if isinstance(body, str) else body
+
+    def delete(self, key):
+        self.objects.pop(key, None)
+
+
+class FakeCursor:
+    # Records every statement and answers fetches from a scripted queue
+    def __init__(self, results=(), rowcount=0):
+        self.statements = []
+        self.results = list(results)
+        self.rowcount = rowcount
+
+    def execute(self, sql, params=None):
+        self.statements.append((" ".join(sql.split()), params))
+
+    def copy_expert(self, sql, source):
+        self.statements.append((" ".join(sql.split()), source.read().decode()))
+
+    def fetchone(self):
+        return self.results.pop(0)
+
+    def fetchall(self):
+        return self.results.pop(0)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, cursor):
+        self.cursor_obj = cursor
+        self.closed = False
+        self.commits = 0
+
+    def cursor(self):
+        return self.cursor_obj
+
+    def commit(self):
+        self.cursor_obj.statements.append(("COMMIT", None))
+        self.commits += 1
+
+    def rollback(self):
+        self.cursor_obj.statements.append(("ROLLBACK", None))
+
+    def close(self):
+        self.closed = True
+
+
+def make_loader(staging_storage, target_warehouse="redshift", **copy_options):
+    return DataLoader(
+        logging.getLogger("tests"),
+        {},
+        "bucket",
+        "/",
+        "KEY",
+        "SECRET",
+        "eu-west-1",
+        "ETL",
+        "deliveryAttempts",
+        "interns.deliveries_attempts",
+        DELIVERIES_ATTEMPTS_COLUMNS,
+        DATA_TYPES,
+        REDSHIFT_TABLE_DESIGN,
+        {**REDSHIFT_COPY_OPTIONS, **copy_options},
+        staging_storage,
+        target_warehouse=target_warehouse,
+    )
+
+
+def test_copy_command_uses_column_list_and_options():
+    loader = make_loader(MemoryS3Storage(), compupdate=False, statupdate=True, maxerror=10, timeformat="auto")
+    command = loader.build_copy_command("s3://bucket/data.csv")
+    lines = command.splitlines()
+    assert lines[0] == f"COPY interns.deliveries_attempts ({', '.join(DELIVERIES_ATTEMPTS_COLUMNS)})"
+    assert "FROM 's3://bucket/data.csv'" in lines
+    assert "FORMAT AS CSV" in lines
+    assert "IGNOREHEADER 1" in lines
+    assert "COMPUPDATE OFF" in lines
+    assert "STATUPDATE ON" in lines
+    assert "MAXERROR 10" in lines
+    assert "TIMEFORMAT 'auto'" in lines
+    assert "MANIFEST" not in lines
+
+
+def test_copy_command_leaves_unset_options_to_redshift():
+    loader = make_loader(MemoryS3Storage(), compupdate=None, statupdate=None, maxerror=None, timeformat=None)
+    command = loader.build_copy_command("s3://bucket/data.csv")
+    for option in ("COMPUPDATE", "STATUPDATE", "MAXERROR", "TIMEFORMAT"):
+        assert option not in command
+
+
+def test_copy_command_with_manifest_and_target_table():
+    loader = make_loader(MemoryS3Storage())
+    command = loader.build_copy_command("s3://bucket/data.manifest", use_manifest=True, target_table="staging_copy")
+    assert command.startswith("COPY staging_copy (")
+    assert "MANIFEST" in command.splitlines()
+
+
+def test_copy_command_rejects_formats_the_transform_does_not_stage():
+    loader = make_loader(MemoryS3Storage(), format="parquet")
+    with pytest.raises(ValueError, match="PARQUET"):
+        loader.build_copy_command("s3://bucket/data.parquet")
+
+
+def test_copy_manifest_lists_every_file_as_mandatory():
+    storage = MemoryS3Storage()
+    loader = make_loader(storage)
+    manifest_key = loader.write_copy_manifest(["out/a.part0000.csv", "out/a.part0001.csv"])
+    assert manifest_key == "out/a.part0000.csv.manifest"
+    assert json.loads(storage.objects[manifest_key]) == {
+        "entries": [
+            {"url": "s3://bucket/out/a.part0000.csv", "mandatory": True},
+            {"url": "s3://bucket/out/a.part0001.csv", "mandatory": True},
+        ]
+    }
+
+
+def test_load_report_combines_copy_count_commits_scans_and_errors():
+    loader = make_loader(MemoryS3Storage(), max_reported_errors=5)
+    cur = FakeCursor(
+        results=[
+            (42, 1500),
+            [(0, "s3://bucket/a.part0000.csv", 800, 0), (1, "s3://bucket/a.part0001.csv", 701, 1)],
+            [(0, 1, 800, 80000), (1, 1, 701, 70100)],
+            [("s3://bucket/a.part0001.csv", 12, "trackingnumber", 1207, "Invalid digit")],
+        ]
+    )
+    report = loader.extract_copy_load_report(cur)
+    assert report["query_id"] == 42
+    assert report["rows_loaded"] == 1500
+    assert report["files"][1] == {"slice": 1, "file": "s3://bucket/a.part0001.csv", "lines_scanned": 701, "errors": 1}
+    assert report["slices"] == [
+        {"slice": 0, "files": 1, "lines": 800, "bytes": 80000},
+        {"slice": 1, "files": 1, "lines": 701, "bytes": 70100},
+    ]
+    assert report["errors"] == [
+        {"file": "s3://bucket/a.part0001.csv", "line_number": 12, "column": "trackingnumber", "err_code": 1207, "err_reason": "Invalid digit"}
+    ]
+    # The per-query lookups are keyed on the COPY's query id, the error list is capped
+    assert cur.statements[1][1] == (42,)
+    assert cur.statements[2][1] == (42,)
+    assert cur.statements[3][1] == (5,)
+
+
+def test_multi_file_copy_goes_through_a_manifest_that_is_removed_afterwards(monkeypatch):
+    storage = MemoryS3Storage()
+    loader = make_loader(storage)
+    cur = FakeCursor(results=[(7, 3), [], [], []])
+    monkeypatch.setattr(load_phase.psycopg2, "connect", lambda **params: FakeConnection(cur))
+    report = loader.copy_from_s3_to_redshift(["out/a.part0000.csv", "out/a.part0001.csv"])
+    copy_sql = cur.statements[0][0]
+    assert "FROM 's3://bucket/out/a.part0000.csv.manifest'" in copy_sql
+    assert "MANIFEST" in copy_sql
+    assert report["rows_loaded"] == 3
+    assert storage.objects == {}
+
+
+def test_replacing_rows_copies_to_a_temp_table_then_swaps_in_one_transaction(monkeypatch):
+    loader = make_loader(MemoryS3Storage())
+    cur = FakeCursor(results=[(7, 3), [], [], []], rowcount=2)
+    monkeypatch.setattr(load_phase.psycopg2, "connect", lambda **params: FakeConnection(cur))
+    report = loader.copy_from_s3_to_redshift("out/a.csv", replace_existing_ids=True)
+    statements = [sql.split(" (")[0] if sql.startswith("COPY") else sql for sql, _ in cur.statements]
+    copy_at = next(i for i, sql in enumerate(statements) if sql.startswith("COPY"))
+    assert statements[0] == "CREATE TEMP TABLE deliveries_attempts_copy_staging (LIKE interns.deliveries_attempts)"
+    assert statements[copy_at] == "COPY deliveries_attempts_copy_staging"
+    # The target table is only touched after the COPY succeeded, and all in the last transaction
+    swap = statements[statements.index("COMMIT") + 1:]
+    assert swap == [
+        "LOCK interns.deliveries_attempts",
+        "DELETE FROM interns.deliveries_attempts USING deliveries_attempts_copy_staging WHERE interns.deliveries_attempts.id = deliveries_attempts_copy_staging.id",
+        f"INSERT INTO interns.deliveries_attempts ({', '.join(DELIVERIES_ATTEMPTS_COLUMNS)}) SELECT {', '.join(DELIVERIES_ATTEMPTS_COLUMNS)} FROM deliveries_attempts_copy_staging",
+        "DROP TABLE deliveries_attempts_copy_staging",
+        "COMMIT",
+    ]
+    assert report["rows_replaced"] == 2
+
+
+def test_local_staging_streams_each_file_and_reports_row_counts(tmp_path):
+    storage = LocalStagingStorage(str(tmp_path))
+    storage.write_bytes("out/a.part0000.csv", "id\n1\n2\n")
+    storage.write_bytes("out/a.part0001.csv", "id\n3\n")
+    loader = make_loader(storage, "postgres")
+    cur = FakeCursor(rowcount=2)
+    report = loader.copy_into_table(cur, ["out/a.part0000.csv", "out/a.part0001.csv"], "interns.deliveries_attempts")
+    assert [sql for sql, _ in cur.statements] == [
+        f"COPY interns.deliveries_attempts ({', '.join(DELIVERIES_ATTEMPTS_COLUMNS)}) FROM STDIN WITH (FORMAT csv, HEADER true)"
+    ] * 2
+    assert [body for _, body in cur.statements] == ["id\n1\n2\n", "id\n3\n"]
+    assert report["rows_loaded"] == 4
+    assert report["slices"] == [] and report["errors"] == []
+
+
+def test_local_staging_creates_the_table_without_redshift_keys(tmp_path):
+    loader = make_loader(LocalStagingStorage(str(tmp_path)), "postgres")
+    assert not loader.loads_into_redshift()
+    ddl = loader.build_create_table_ddl(physical_design=False)
+    assert "DISTKEY" not in ddl and "SORTKEY" not in ddl and "DISTSTYLE" not in ddl
+    assert "DISTKEY (id)" in make_loader(MemoryS3Storage()).build_create_table_ddl()
+
+
+def test_pending_row_hash_index_is_promoted_to_current(tmp_path):
+    storage = LocalStagingStorage(str(tmp_path))
+    storage.write_bytes(ROW_HASH_INDEX_KEY, b"old")
+    storage.write_bytes(PENDING_ROW_HASH_INDEX_KEY, b"new")
+    make_loader(storage, "postgres").promote_row_hash_index()
+    assert open(storage.path_for(ROW_HASH_INDEX_KEY), "rb").read() == b"new"
+    assert not storage.exists(PENDING_ROW_HASH_INDEX_KEY)
+
+
+def test_pending_row_hash_index_is_discarded_when_copy_may_reject_rows(tmp_path):
+    storage = LocalStagingStorage(str(tmp_path))
+    storage.write_bytes(ROW_HASH_INDEX_KEY, b"old")
+    storage.write_bytes(PENDING_ROW_HASH_INDEX_KEY, b"new")
+    loader = make_loader(storage, "postgres", maxerror=10)
+    assert not loader.supports_change_detection()
+    loader.promote_row_hash_index()
+    assert open(storage.path_for(ROW_HASH_INDEX_KEY), "rb").read() == b"old"
+    assert not storage.exists(PENDING_ROW_HASH_INDEX_KEY)
+
+
+def record_load_steps(loader, monkeypatch, copy_error=None):
+    calls = []
+
+    def copy(s3_object_key, replace_existing_ids=False):
+        calls.append("copy")
+        if copy_error:
+            raise copy_error
+        return {"rows_loaded": 1}
+
+    monkeypatch.setattr(loader, "ensure_target_table", lambda: calls.append("ensure"))
+    monkeypatch.setattr(loader, "copy_from_s3_to_redshift", copy)
+    monkeypatch.setattr(loader, "promote_row_hash_index", lambda: calls.append("promote"))
+    monkeypatch.setattr(loader, "update_latest_updated_at", lambda job, value: calls.append(f"watermark {value}"))
+    monkeypatch.setattr(loader, "cleanup_s3", lambda key: calls.append("cleanup"))
+    return calls
+
+
+def test_watermark_advances_only_after_copy_and_promotion(tmp_path, monkeypatch):
+    loader = make_loader(LocalStagingStorage(str(tmp_path)), "postgres")
+    calls = record_load_steps(loader, monkeypatch)
+    loader.run_loading("2025-08-01 10:00:00", "out.csv", delete_duplicates=False)
+    assert calls == ["ensure", "copy", "promote", "watermark 2025-08-01 10:00:00", "cleanup"]
+
+
+def test_failed_copy_leaves_the_watermark_alone(tmp_path, monkeypatch):
+    loader = make_loader(LocalStagingStorage(str(tmp_path)), "postgres")
+    calls = record_load_steps(loader, monkeypatch, copy_error=RuntimeError("COPY failed"))
+    with pytest.raises(RuntimeError):
+        loader.run_loading("2025-08-01 10:00:00", "out.csv", delete_duplicates=False)
+    assert calls == ["ensure", "copy"]
+
+
+def table_info(diststyle="KEY(id)", sortkey1="updatedAt", tbl_rows=1000, estimated_visible_rows=1000):
+    return {
+        "diststyle": diststyle,
+        "sortkey1": sortkey1,
+        "tbl_rows": tbl_rows,
+        "estimated_visible_rows": estimated_visible_rows,
+        "unsorted": 0,
+    }
+
+
+@pytest.mark.parametrize("visible_rows, vacuum_ran", [(960, False), (950, True), (900, True)])
+def test_vacuum_runs_once_deleted_rows_reach_the_threshold(monkeypatch, visible_rows, vacuum_ran):
+    loader = make_loader(MemoryS3Storage())
+    cur = FakeCursor()
+    monkeypatch.setattr(load_phase.psycopg2, "connect", lambda **params: FakeConnection(cur))
+    monkeypatch.setattr(loader, "extract_table_info", lambda: table_info(estimated_visible_rows=visible_rows))
+
+    maintenance = loader.maintain_table()
+
+    assert maintenance == {"deleted_ratio": pytest.approx(1 - visible_rows / 1000), "vacuum_ran": vacuum_ran}
+    expected = ["VACUUM DELETE ONLY interns.deliveries_attempts;", "ANALYZE interns.deliveries_attempts;"]
+    assert [sql for sql, _ in cur.statements] == (expected if vacuum_ran else [])
+
+
+def test_maintenance_of_an_empty_table_reports_no_ratio(monkeypatch):
+    loader = make_loader(MemoryS3Storage())
+    monkeypatch.setattr(loader, "extract_table_info", lambda: table_info(tbl_rows=0, estimated_visible_rows=0))
+    assert loader.maintain_table() == {"deleted_ratio": None, "vacuum_ran": False}
+
+
+def ensure_table_with(monkeypatch, info, enforce):
+    loader = make_loader(MemoryS3Storage())
+    loader.table_design = {**loader.table_design, "enforce": enforce}
+    cur = FakeCursor()
+    monkeypatch.setattr(load_phase.psycopg2, "connect", lambda **params: FakeConnection(cur))
+    monkeypatch.setattr(loader, "extract_table_info", lambda: info)
+    loader.ensure_target_table()
+    # The CREATE TABLE IF NOT EXISTS and its COMMIT come first
+    return [sql for sql, _ in cur.statements[2:]]
+
+
+def test_key_mismatch_alters_dist_and_sort_keys_when_enforced(monkeypatch):
+    statements = ensure_table_with(monkeypatch, table_info(diststyle="EVEN", sortkey1="createdAt"), enforce=True)
+    assert statements == [
+        "ALTER TABLE interns.deliveries_attempts ALTER DISTKEY id",
+        "ALTER TABLE interns.deliveries_attempts ALTER SORTKEY (updatedAt)",
+    ]
+
+
+def test_key_mismatch_only_warns_by_default(monkeypatch):
+    assert ensure_table_with(monkeypatch, table_info(diststyle="EVEN", sortkey1="createdAt"), enforce=False) == []
+
+
+def test_matching_keys_need_no_alter(monkeypatch):
+    assert ensure_table_with(monkeypatch, table_info(), enforce=True) == []
+
+
+def test_redshift_cannot_be_loaded_from_local_staging(tmp_path):
+    with pytest.raises(ValueError):
+        make_loader(LocalStagingStorage(str(tmp_path)))
+    with pytest.raises(ValueError):
+        make_loader(MemoryS3Storage(), "snowflake")
@@ -0,0 +1,72 @@
+import logging
+import os
+
+import pandas as pd
+import psycopg2
+import pytest
+
+from config import DELIVERIES_ATTEMPTS_COLUMNS, DATA_TYPES, REDSHIFT_TABLE_DESIGN, REDSHIFT_COPY_OPTIONS
+from load_phase import DataLoader
+from staging_storage import LocalStagingStorage
+
+# Runs the load phase end to end against a local Postgres, e.g.
+# TEST_POSTGRES_DSN="dbname=etl_test user=postgres host=localhost" python -m pytest tests
+POSTGRES_DSN = os.getenv("TEST_POSTGRES_DSN")
+TEST_TABLE = "etl_test.deliveries_attempts"
+
+pytestmark = pytest.mark.skipif(not POSTGRES_DSN, reason="TEST_POSTGRES_DSN is not set")
+
+
+@pytest.fixture
+def loader(tmp_path):
+    with psycopg2.connect(POSTGRES_DSN) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute("CREATE SCHEMA IF NOT EXISTS etl_test")
+            cursor.execute(f"DROP TABLE IF EXISTS {TEST_TABLE}")
+    yield DataLoader(
+        logging.getLogger("tests"),
+        {"dsn": POSTGRES_DSN},
+        None,
+        "/",
+        None,
+        None,
+        None,
+        "ETL",
+        "deliveryAttempts",
+        TEST_TABLE,
+        DELIVERIES_ATTEMPTS_COLUMNS,
+        DATA_TYPES,
+        REDSHIFT_TABLE_DESIGN,
+        REDSHIFT_COPY_OPTIONS,
+        LocalStagingStorage(str(tmp_path)),
+        target_warehouse="postgres",
+    )
+    with psycopg2.connect(POSTGRES_DSN) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"DROP TABLE IF EXISTS {TEST_TABLE}")
+
+
+def stage_rows(loader, key, ids, updated_at):
+    df = pd.DataFrame({col: "" for col in DELIVERIES_ATTEMPTS_COLUMNS}, index=range(len(ids)))
+    for col, dtype in DATA_TYPES.items():
+        if dtype is bool:
+            df[col] = False
+        elif dtype in ("int", "int64"):
+            df[col] = 1
+        elif str(dtype).startswith("datetime64"):
+            df[col] = updated_at
+    df["id"] = ids
+    loader.staging_storage.write_bytes(key, df[DELIVERIES_ATTEMPTS_COLUMNS].to_csv(index=False))
+
+
+def test_load_and_replace_rows_in_postgres(loader):
+    stage_rows(loader, "out/first.csv", ["a", "b"], "2025-08-01 00:00:00")
+    loader.run_loading(None, "out/first.csv", update_watermark=False)
+    assert loader.run_metrics["rows_copied"] == 2
+    assert loader.run_metrics["table_rows"] == 2
+
+    # A backfill reload replaces b and adds c without touching a
+    stage_rows(loader, "out/second.csv", ["b", "c"], "2025-08-02 00:00:00")
+    loader.run_loading(None, "out/second.csv", update_watermark=False, delete_duplicates=False, replace_existing_ids=True)
+    assert loader.run_metrics["copy_load_report"]["rows_replaced"] == 1
+    assert loader.count_table_rows() == 3
@@ -0,0 +1,49 @@
+import logging
+
+import pandas as pd
+
+from performance_log import PerformanceHistory, RunRecorder, cost_per_row
+
+
+def test_recorder_counts_rows_of_frames_and_document_lists_only():
+    recorder = RunRecorder("transform", "run")
+    recorder.call("frame", lambda: pd.DataFrame({"a": range(3)}))
+    recorder.call("documents", lambda: [{"_id": 1}, {"_id": 2}])
+    recorder.call("file_keys", lambda: ["a.part0000.csv", "a.part0001.csv"])
+    recorder.call("deleted_count", lambda: 5)
+    assert [step["rows"] for step in recorder.steps] == [3, 2, None, None]
+
+
+def test_annotate_rows_sets_named_steps_or_the_last_one():
+    recorder = RunRecorder("load", "run")
+    for name in ("copy", "dedup", "maintain"):
+        recorder.call(name, lambda: None)
+    recorder.annotate_rows(10)
+    recorder.annotate_rows(1000, "dedup", "copy")
+    assert [step["rows"] for step in recorder.steps] == [1000, 1000, 10]
+
+
+def test_cost_per_row_falls_back_to_the_batch_size():
+    costs = cost_per_row({"copy": (10.0, 1000, 1000), "cleanup": (1.0, None, 1000), "metadata": (1.0, None, None)})
+    assert costs == {"copy": (10.0, 0.01), "cleanup": (1.0, 0.001), "metadata": (1.0, None)}
+
+
+def test_regression_report_flags_steps_slower_per_row(tmp_path):
+    history = PerformanceHistory(str(tmp_path / "history.sqlite"), logging.getLogger("tests"))
+    for index, (dedup_seconds, table_rows) in enumerate([(30, 10**6), (30, 10**6), (30, 10**6), (90, 10**6)]):
+        recorder = RunRecorder("load", f"run{index}")
+        recorder.steps = [
+            {"step": "copy_from_s3_to_redshift", "seconds": 10.0, "rows": 50000},
+            {"step": "delete_duplicates_from_redshift", "seconds": dedup_seconds, "rows": table_rows},
+        ]
+        recorder.batch_rows = 50000
+        history.append_run(recorder, "success", {"rows_deduplicated": 5 if index == 3 else 10000})
+    failed = RunRecorder("load", "failed")
+    failed.steps = [{"step": "copy_from_s3_to_redshift", "seconds": 999.0, "rows": 1}]
+    history.append_run(failed, "failed")
+
+    report = {entry["step"]: entry for entry in history.regression_report(baseline_runs=10, threshold=1.5, min_seconds=1.0)}
+    assert report["copy_from_s3_to_redshift"]["run_id"] == "run3"
+    assert not report["copy_from_s3_to_redshift"]["regressed"]
+    assert report["delete_duplicates_from_redshift"]["ratio"] == 3.0
+    assert report["delete_duplicates_from_redshift"]["regressed"]
@@ -0,0 +1,50 @@
+import pandas as pd
+
+from staging_storage import S3StagingStorage
+
+
+class FakeS3Client:
+    # Records the multipart upload calls S3StagingStorage makes
+    def __init__(self):
+        self.parts = []
+        self.completed = None
+
+    def create_multipart_upload(self, Bucket, Key):
+        return {"UploadId": "upload"}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.parts.append(Body)
+        return {"ETag": f"etag{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.completed = MultipartUpload["Parts"]
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        pass
+
+
+def make_storage():
+    storage = S3StagingStorage("bucket", "KEY", "SECRET", "eu-west-1")
+    storage.s3_client = FakeS3Client()
+    return storage
+
+
+def test_chunks_bigger_than_a_part_are_cut_at_part_size():
+    storage = make_storage()
+    frames = [pd.DataFrame({"value": ["x" * 99] * 10}), pd.DataFrame({"value": ["y" * 99] * 10})]
+    written = []
+    storage.write_frame_chunks("raw.csv", iter(frames), lambda: 300, lambda nbytes, seconds: written.append(nbytes))
+
+    parts = storage.s3_client.parts
+    # 6 bytes of header plus 20 rows of 100 bytes
+    assert [len(part) for part in parts] == [300] * 6 + [206]
+    assert b"".join(parts) == b"".join(frame.to_csv(index=False, header=index == 0).encode() for index, frame in enumerate(frames))
+    assert written == [len(part) for part in parts]
+    assert [part["PartNumber"] for part in storage.s3_client.completed] == list(range(1, 8))
+
+
+def test_part_size_is_asked_again_before_every_part():
+    storage = make_storage()
+    sizes = iter([500, 200, 200, 200])
+    storage.write_frame_chunks("raw.csv", iter([pd.DataFrame({"value": ["x" * 99] * 10})]), lambda: next(sizes))
+    assert [len(part) for part in storage.s3_client.parts] == [500, 200, 200, 106]
@@ -0,0 +1,32 @@
+import logging
+
+from throughput_controller import MIN_S3_PART_SIZE, ThroughputController
+
+
+def make_controller(**budgets):
+    return ThroughputController(logging.getLogger("tests"), **budgets)
+
+
+def test_batch_size_moves_halfway_towards_the_latency_target():
+    controller = make_controller(initial_batch_size=1000, max_batch_size=20000, target_batch_seconds=1.0)
+    controller.record_read(1000, 1000 * 500, 0.25)
+    # 4000 docs/s would fill a 1s page with 4000 docs, half way from 1000 is 2500
+    assert controller.batch_size == 2500
+    assert controller.decisions[0]["setting"] == "batch_size"
+
+
+def test_batch_size_stays_inside_the_memory_budget():
+    controller = make_controller(initial_batch_size=1000, memory_budget_bytes=4 * 1024 * 1024, max_batch_size=20000)
+    controller.record_read(1000, 1000 * 10 * 1024, 0.01)
+    # A page may use a quarter of the budget: 1 MiB / 10 KiB per doc
+    assert controller.batch_size == 102
+
+
+def test_part_size_follows_upload_speed_within_s3_limits():
+    controller = make_controller(min_part_size=1024, max_part_size=64 * 1024 * 1024, target_part_seconds=2.0)
+    assert controller.part_size == MIN_S3_PART_SIZE
+    controller.record_write(10 * 1024 * 1024, 1.0)
+    assert controller.part_size == 20 * 1024 * 1024
+    controller.record_write(1024, 1.0)
+    assert controller.part_size == MIN_S3_PART_SIZE
+    assert controller.metrics()["bytes_written"] == 10 * 1024 * 1024 + 1024
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+
+from config import VALIDATION_SCHEMA
+from transform_kernels import find_schema_violations, normalize_nan_tokens, normalize_tristate_boolean, strip_and_truncate
+
+
+def test_strip_and_truncate_cuts_to_bytes_on_character_boundaries():
+    block = pd.DataFrame({"business_name": ["م" * 200, "x" * 400, "a" + "é" * 300, None], "exception_reason": ["  late  "] * 4})
+    result = strip_and_truncate(block, {"business_name": 300, "exception_reason": 200}, ["exception_reason"])
+    assert [len(value.encode()) for value in result["business_name"][:3]] == [300, 300, 299]
+    assert result["business_name"][0] == "م" * 150
+    assert result["business_name"][3] is None
+    assert result["exception_reason"].tolist() == ["late"] * 4
+
+
+def test_normalize_nan_tokens_blanks_missing_values():
+    block = pd.DataFrame({"a": ["nan", "NaT", None, "value"], "b": [np.nan, "NaN", "x", "NAN"]})
+    assert normalize_nan_tokens(block).to_dict("list") == {"a": ["", "", "", "value"], "b": ["", "", "x", ""]}
+
+
+def test_normalize_tristate_boolean_keeps_unknowns_as_na():
+    series = pd.Series([True, "False", "true", 0, np.nan, "maybe"])
+    assert normalize_tristate_boolean(series).tolist() == [True, False, True, False, pd.NA, pd.NA]
+
+
+def test_schema_violations_flag_each_broken_rule():
+    schema = {**VALIDATION_SCHEMA, "state": {**VALIDATION_SCHEMA["state"], "allowed_values": [1, 2]}}
+    df = pd.DataFrame(
+        {
+            "id": ["1", "", "3", "4"],
+            "trackingNumber": ["100", "not-a-number", "300", "99999999999999999999"],
+            "createdAt": ["2025-08-01 10:00:00", "2025-08-01 10:00:00", "yesterday", "2025-08-01 10:00:00"],
+            "updatedAt": ["2025-08-01 10:00:00"] * 4,
+            "state": [1, 2, 99, 3000000000],
+            "star_phone": ["0100", "0100", "9" * 300, "0100"],
+        }
+    )
+    violations, parsed = find_schema_violations(df, schema)
+    broken = {col: violations.index[violations[col]].tolist() for col in violations.columns if violations[col].any()}
+    assert broken == {
+        "id:nullable": [1],
+        "trackingNumber:type": [1, 3],
+        "createdAt:type": [2],
+        # state is an "int", a Redshift INTEGER, so 3000000000 is out of range as well as not allowed
+        "state:type": [3],
+        "state:allowed_values": [2, 3],
+        "star_phone:max_length": [2],
+    }
+    assert parsed["trackingNumber"].tolist()[0] == 100
+
+
+def test_state_check_is_off_without_allowed_states():
+    violations, _ = find_schema_violations(pd.DataFrame({"state": [1, 99]}), {"state": {"dtype": "int", "allowed_values": None}})
+    assert "state:allowed_values" not in violations.columns
@@ -0,0 +1,128 @@
+import io
+import logging
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from config import COLUMNS_TO_SELECT, DATA_TYPES, EGYPT_TZ, MSG_TEXT, REGION_NAME, VALIDATION_SCHEMA
+from staging_storage import LocalStagingStorage
+from transform_phase import PENDING_ROW_HASH_INDEX_KEY, QUARANTINE_S3_PREFIX, ROW_HASH_INDEX_KEY, DataTransformer
+
+
+@pytest.fixture
+def transformer(tmp_path):
+    return DataTransformer(
+        EGYPT_TZ, COLUMNS_TO_SELECT, MSG_TEXT, logging.getLogger("tests"), DATA_TYPES,
+        None, None, None, "/", REGION_NAME, VALIDATION_SCHEMA, LocalStagingStorage(str(tmp_path)),
+    )
+
+
+def raw_documents(tracking_numbers):
+    return pd.DataFrame(
+        {
+            "_id": [f"id{index}" for index in range(len(tracking_numbers))],
+            "trackingNumber": tracking_numbers,
+            "createdAt": "2025-08-01 09:00:00",
+            "updatedAt": [f"2025-08-0{index + 1} 10:00:00" for index in range(len(tracking_numbers))],
+            "state": 1,
+        }
+    )
+
+
+def test_validate_rows_quarantines_bad_rows_and_keeps_the_rest(transformer):
+    df = pd.DataFrame(
+        {
+            "id": ["a", "b", "c"],
+            "trackingNumber": ["100", "ABC", "99999999999999999999"],
+            "createdAt": ["2025-08-01 10:00:00"] * 3,
+            "updatedAt": ["2025-08-01 10:00:00"] * 3,
+        }
+    )
+    valid_df = transformer.validate_rows(df, "data/delivery_attempts.csv")
+
+    assert valid_df["id"].tolist() == ["a"]
+    # Parsed columns are handed on so astype does not parse them again
+    assert valid_df["trackingNumber"].tolist() == [100]
+    assert transformer.run_metrics["rows_quarantined"] == 2
+
+    quarantine_key = transformer.run_metrics["quarantine_s3_object_key"]
+    assert quarantine_key.startswith(QUARANTINE_S3_PREFIX) and quarantine_key.endswith("_delivery_attempts.csv")
+    quarantined = transformer.staging_storage.read_frame(quarantine_key)
+    assert quarantined["id"].tolist() == ["b", "c"]
+    assert quarantined["validation_errors"].tolist() == ["trackingNumber:type", "trackingNumber:type"]
+
+
+def test_validate_rows_without_violations_writes_no_quarantine(transformer):
+    df = pd.DataFrame({"id": ["a"], "trackingNumber": ["100"], "createdAt": ["2025-08-01"], "updatedAt": ["2025-08-01"]})
+    transformer.validate_rows(df)
+    assert transformer.run_metrics == {"rows_quarantined": 0}
+
+
+def test_watermark_covers_quarantined_rows(transformer):
+    transformer.staging_storage.write_frame("raw.csv", raw_documents(["100", "ABC", "ABC"]))
+    last_updated_at, s3_object_key = transformer.run_transformation("raw.csv", "out.csv", detect_changes=False)
+    assert last_updated_at == "2025-08-03 10:00:00"
+    assert transformer.run_metrics["rows_loaded"] == 1
+
+
+def test_fully_quarantined_batch_still_has_a_watermark(transformer):
+    transformer.staging_storage.write_frame("raw.csv", raw_documents(["ABC", "ABC", "ABC"]))
+    last_updated_at, _ = transformer.run_transformation("raw.csv", "out.csv", detect_changes=False)
+    assert last_updated_at == "2025-08-03 10:00:00"
+    assert transformer.run_metrics["rows_loaded"] == 0
+
+
+def write_row_hash_index(transformer, ids, row_hashes, last_seen):
+    index_df = pd.DataFrame({"id": ids, "row_hash": np.array(row_hashes, dtype="uint64"), "last_seen": last_seen})
+    parquet_buffer = io.BytesIO()
+    index_df.to_parquet(parquet_buffer, index=False)
+    transformer.staging_storage.write_bytes(ROW_HASH_INDEX_KEY, parquet_buffer.getvalue())
+
+
+def read_pending_index(transformer):
+    return pd.read_parquet(transformer.staging_storage.path_for(PENDING_ROW_HASH_INDEX_KEY)).set_index("id")
+
+
+def insert_rows(ids, tracking_numbers):
+    return pd.DataFrame({"id": ids, "trackingNumber": tracking_numbers, "updatedAt": "2025-08-01 10:00:00"})
+
+
+def test_unchanged_rows_match_on_exact_uint64_hashes(transformer):
+    insert_df = insert_rows(["a", "b"], [100, 200])
+    row_hashes = transformer.compute_row_hashes(insert_df)
+    # Hashes one apart above 2**53 collapse to the same float64, the lookup must keep them distinct
+    assert (row_hashes > 2**53).all()
+    now = pd.Timestamp(datetime.utcnow())
+    write_row_hash_index(transformer, ["a", "b"], [row_hashes[0], row_hashes[1] ^ 1], now)
+
+    changed_df = transformer.filter_unchanged_rows(insert_df)
+
+    assert changed_df["id"].tolist() == ["b"]
+    assert transformer.run_metrics["rows_unchanged"] == 1
+    assert transformer.run_metrics["change_filter_ratio"] == 0.5
+
+
+def test_duplicate_ids_in_a_batch_keep_the_last_hash(transformer):
+    insert_df = insert_rows(["a", "a"], [100, 200])
+    changed_df = transformer.filter_unchanged_rows(insert_df)
+
+    assert len(changed_df) == 2
+    pending = read_pending_index(transformer)
+    assert pending.index.tolist() == ["a"]
+    assert pending.loc["a", "row_hash"] == transformer.compute_row_hashes(insert_df)[1]
+
+
+def test_ids_not_seen_within_the_retention_period_are_pruned(transformer):
+    now = pd.Timestamp(datetime.utcnow())
+    write_row_hash_index(
+        transformer, ["recent", "stale"], [1, 2], [now - pd.Timedelta(days=10), now - pd.Timedelta(days=40)]
+    )
+    transformer.filter_unchanged_rows(insert_rows(["a"], [100]))
+
+    pending = read_pending_index(transformer)
+    assert sorted(pending.index) == ["a", "recent"]
+    assert transformer.run_metrics["row_hash_index_size"] == 2
+    # The current index is left alone until the load phase promotes the pending one
+    assert transformer.staging_storage.exists(ROW_HASH_INDEX_KEY)
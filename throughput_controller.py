@@ -0,0 +1,104 @@
+MIN_S3_PART_SIZE = 5 * 1024 * 1024
+
+
+class ThroughputController:
+    # Sizes Mongo read pages, staged chunks and S3 multipart parts from measured throughput,
+    # staying inside the latency budgets from config (THROUGHPUT_BUDGETS). memory_budget_bytes caps
+    # those buffers only; the extracted batch as a whole is not bounded by it.
+    def __init__(
+        self,
+        logger,
+        initial_batch_size=1000,
+        min_batch_size=100,
+        max_batch_size=20000,
+        target_batch_seconds=1.0,
+        memory_budget_bytes=256 * 1024 * 1024,
+        min_part_size=MIN_S3_PART_SIZE,
+        max_part_size=128 * 1024 * 1024,
+        target_part_seconds=2.0,
+        max_time_ms=60000,
+    ):
+        self.logger = logger
+        self.min_batch_size = min_batch_size
+        self.max_batch_size = max_batch_size
+        self.target_batch_seconds = target_batch_seconds
+        self.memory_budget_bytes = memory_budget_bytes
+        # S3 rejects parts under 5 MiB (except the last one)
+        self.min_part_size = max(min_part_size, MIN_S3_PART_SIZE)
+        self.max_part_size = max_part_size
+        self.target_part_seconds = target_part_seconds
+        self.max_time_ms = max_time_ms
+
+        self.batch_size = initial_batch_size
+        self.part_size = self.min_part_size
+        self.chunk_rows = initial_batch_size
+        self.avg_doc_bytes = None
+
+        self.docs_read = 0
+        self.bytes_read = 0
+        self.read_seconds = 0.0
+        self.bytes_written = 0
+        self.write_seconds = 0.0
+        self.decisions = []
+
+    def clamp(self, value, low, high):
+        return int(max(low, min(high, value)))
+
+    def record_decision(self, setting, old_value, new_value, reason):
+        # Only changes of more than 10% are worth a line in the logs and run metrics
+        if abs(new_value - old_value) <= 0.1 * old_value:
+            return
+        self.decisions.append({"setting": setting, "from": old_value, "to": new_value, "reason": reason})
+        self.logger.info(f"Throughput controller: {setting} {old_value} -> {new_value} ({reason})")
+
+    def record_read(self, docs, nbytes, seconds):
+        # Feed back one Mongo page and resize the next one so it takes about target_batch_seconds
+        self.docs_read += docs
+        self.bytes_read += nbytes
+        self.read_seconds += seconds
+        if not docs or seconds <= 0:
+            return
+        self.avg_doc_bytes = self.bytes_read / self.docs_read
+        docs_per_second = docs / seconds
+
+        # Move halfway towards the size that would hit the latency target, so one slow page
+        # during peak hours shrinks the next page without collapsing it
+        target = docs_per_second * self.target_batch_seconds
+        proposed = (self.batch_size + target) / 2
+        # One page must also fit comfortably (a quarter) in the memory budget
+        memory_cap = self.memory_budget_bytes / 4 / self.avg_doc_bytes
+        new_batch_size = self.clamp(proposed, self.min_batch_size, min(self.max_batch_size, memory_cap))
+        reason = f"{docs_per_second:.0f} docs/s, page took {seconds:.2f}s"
+        self.record_decision("batch_size", self.batch_size, new_batch_size, reason)
+        self.batch_size = new_batch_size
+
+        # A staged chunk is encoded in memory before upload, keep it within half the budget
+        new_chunk_rows = self.clamp(self.memory_budget_bytes / 2 / self.avg_doc_bytes, self.min_batch_size, float("inf"))
+        self.record_decision("chunk_rows", self.chunk_rows, new_chunk_rows, f"{self.avg_doc_bytes:.0f} bytes/doc")
+        self.chunk_rows = new_chunk_rows
+
+    def record_write(self, nbytes, seconds):
+        # Feed back one uploaded part and size the next so it takes about target_part_seconds
+        self.bytes_written += nbytes
+        self.write_seconds += seconds
+        if not nbytes or seconds <= 0:
+            return
+        bytes_per_second = nbytes / seconds
+        upper = min(self.max_part_size, self.memory_budget_bytes / 2)
+        new_part_size = self.clamp(bytes_per_second * self.target_part_seconds, self.min_part_size, upper)
+        self.record_decision("part_size", self.part_size, new_part_size, f"{bytes_per_second / 1024 / 1024:.1f} MiB/s upload")
+        self.part_size = new_part_size
+
+    def metrics(self):
+        return {
+            "docs_read": self.docs_read,
+            "bytes_read": self.bytes_read,
+            "docs_per_second": self.docs_read / self.read_seconds if self.read_seconds else None,
+            "read_bytes_per_second": self.bytes_read / self.read_seconds if self.read_seconds else None,
+            "bytes_written": self.bytes_written,
+            "write_bytes_per_second": self.bytes_written / self.write_seconds if self.write_seconds else None,
+            "final_batch_size": self.batch_size,
+            "final_chunk_rows": self.chunk_rows,
+            "final_part_size": self.part_size,
+            "decisions": self.decisions,
+        }
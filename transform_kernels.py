@@ -0,0 +1,123 @@
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# Tokens that pandas/CSV round trips leave behind in place of a missing value
+NAN_TOKENS = ["nan", "NAN", "NaN", "NaT"]
+
+# Values accepted as true/false by the tri-state boolean normaliser, anything else becomes NA
+TRUE_TOKENS = [True, "true", "True", "TRUE", "1", "1.0", "t", "yes"]
+FALSE_TOKENS = [False, "false", "False", "FALSE", "0", "0.0", "f", "no"]
+
+# Value ranges of the integer dtypes in DATA_TYPES: "int" maps to Redshift INTEGER, "int64" to BIGINT
+INT_RANGES = {"int": (-2**31, 2**31 - 1), "int64": (-2**63, 2**63 - 1)}
+
+
+def normalize_nan_tokens(block):
+    # Replace NaN/None and the NaN-like string tokens with "" across a whole block of columns at once
+    values = block.to_numpy(dtype=object, copy=True)
+    missing_mask = pd.isna(values) | block.isin(NAN_TOKENS).to_numpy()
+    values[missing_mask] = ""
+    return pd.DataFrame(values, index=block.index, columns=block.columns)
+
+
+def truncate_utf8_bytes(arr, over_mask, max_bytes):
+    # Cut the flagged values to max_bytes of UTF-8 without leaving half a multi-byte character
+    values = arr.to_pylist()
+    for position in np.flatnonzero(over_mask.to_numpy(zero_copy_only=False)):
+        values[position] = values[position].encode()[:max_bytes].decode("utf-8", "ignore")
+    return pa.array(values, type=pa.string())
+
+
+def strip_and_truncate(block, max_lengths, strip_columns=()):
+    # Strip (where asked) and cut each string column to its max length in bytes, the unit of
+    # Redshift VARCHAR limits, using Arrow compute kernels
+    table = pa.Table.from_pandas(block, preserve_index=False)
+    columns = []
+    for col in block.columns:
+        arr = table.column(col)
+        if not pa.types.is_string(arr.type):
+            arr = pc.cast(arr, pa.string())
+        if col in strip_columns:
+            arr = pc.utf8_trim_whitespace(arr)
+        if col in max_lengths:
+            max_bytes = max_lengths[col]
+            # A value never has more bytes than characters, so the character cut is exact for ASCII;
+            # only multi-byte text (e.g. Arabic names) that is still too long goes through Python
+            arr = pc.utf8_slice_codeunits(arr, 0, max_bytes)
+            over_mask = pc.fill_null(pc.greater(pc.binary_length(arr), max_bytes), False)
+            if pc.any(over_mask).as_py():
+                arr = truncate_utf8_bytes(arr, over_mask, max_bytes)
+        columns.append(arr)
+    result = pa.table(columns, names=list(block.columns)).to_pandas()
+    result.index = block.index
+    return result
+
+
+def normalize_tristate_boolean(series):
+    # Map a mixed bool/str/number column to pandas' nullable boolean: True, False or <NA>
+    # isin hashes True == 1 == 1.0, so real bools and numbers match alongside the string tokens
+    true_mask = series.isin(TRUE_TOKENS).to_numpy()
+    false_mask = series.isin(FALSE_TOKENS).to_numpy()
+    result = pd.array(true_mask, dtype="boolean")
+    result[~(true_mask | false_mask)] = pd.NA
+    return pd.Series(result, index=series.index, name=series.name)
+
+
+def string_byte_lengths(series):
+    # UTF-8 byte length of every value (nulls count as 0), computed by Arrow
+    try:
+        text = pa.array(series, type=pa.string(), from_pandas=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        text = pa.array(series.astype(str), type=pa.string())
+    return pc.fill_null(pc.binary_length(text), 0).to_numpy(zero_copy_only=False)
+
+
+def find_schema_violations(df, schema):
+    # Build one boolean mask per (column, rule) that a row breaks, e.g. "trackingNumber:type".
+    # Numeric and datetime columns are parsed once here and handed back so the astype that
+    # follows does not have to parse the strings a second time.
+    violations = {}
+    parsed_columns = {}
+    for col, rules in schema.items():
+        if col not in df.columns:
+            continue
+        series = df[col]
+        dtype = rules.get("dtype")
+        needs_presence = (
+            not rules.get("nullable", True)
+            or dtype in ("int", "int64")
+            or (isinstance(dtype, str) and dtype.startswith("datetime64"))
+            or rules.get("allowed_values")
+        )
+        if needs_presence:
+            missing = series.isna().to_numpy()
+            if series.dtype == object:
+                missing |= (series == "").to_numpy()
+            present = ~missing
+
+        if not rules.get("nullable", True):
+            violations[f"{col}:nullable"] = missing
+
+        if dtype in ("int", "int64"):
+            numeric = series if pd.api.types.is_numeric_dtype(series) else pd.to_numeric(series, errors="coerce")
+            # astype wraps values outside the range silently; "int" loads into a Redshift INTEGER
+            low, high = INT_RANGES[dtype]
+            out_of_range = (numeric < low) | (numeric > high)
+            violations[f"{col}:type"] = present & (numeric.isna() | (numeric % 1 != 0) | out_of_range).to_numpy()
+            parsed_columns[col] = numeric
+            if rules.get("allowed_values"):
+                violations[f"{col}:allowed_values"] = present & ~numeric.isin(rules["allowed_values"]).to_numpy()
+        elif isinstance(dtype, str) and dtype.startswith("datetime64"):
+            parsed = pd.to_datetime(series, errors="coerce", format="ISO8601")
+            violations[f"{col}:type"] = present & parsed.isna().to_numpy()
+            if getattr(parsed.dtype, "tz", None) is None:
+                parsed_columns[col] = parsed
+        elif rules.get("allowed_values"):
+            violations[f"{col}:allowed_values"] = present & ~series.isin(rules["allowed_values"]).to_numpy()
+
+        if rules.get("max_length") and series.dtype == object:
+            # Redshift VARCHAR limits count bytes, not characters
+            violations[f"{col}:max_length"] = string_byte_lengths(series) > rules["max_length"]
+    return pd.DataFrame(violations, index=df.index), parsed_columns
@@ -3,11 +3,21 @@ import numpy as np
 import pytz
 from flatten_json import flatten
 import io
-import boto3
-from datetime import date, timedelta
+import os
+from datetime import date, datetime, timedelta
+from extract_phase import RAW_S3_OBJECT_KEY
+from staging_storage import S3StagingStorage
+from performance_log import RunRecorder
+from transform_kernels import normalize_nan_tokens, strip_and_truncate, normalize_tristate_boolean, find_schema_violations
+
+# id -> content hash of the last loaded version of each document; the pending copy is
+# promoted by the load phase only after its COPY succeeded
+ROW_HASH_INDEX_KEY = "data/row_hash_index.parquet"
+PENDING_ROW_HASH_INDEX_KEY = "data/row_hash_index.pending.parquet"
+QUARANTINE_S3_PREFIX = "data/quarantine/"
 
 class DataTransformer:
-    def __init__(self, EGYPT_TZ, COLUMNS_TO_SELECT, MSG_TEXT, logger, DATA_TYPES, aws_access_key_id, aws_secret_access_key, s3_bucket_name, s3_partition_prefix, REGION_NAME):
+    def __init__(self, EGYPT_TZ, COLUMNS_TO_SELECT, MSG_TEXT, logger, DATA_TYPES, aws_access_key_id, aws_secret_access_key, s3_bucket_name, s3_partition_prefix, REGION_NAME, VALIDATION_SCHEMA, staging_storage=None, performance_history=None, output_file_count=1, row_hash_index_retention_days=30):
         # Store all config and credentials needed for transformation
         self.egypt_tz = EGYPT_TZ
         self.columns_to_select = COLUMNS_TO_SELECT
@@ -19,32 +29,31 @@ class DataTransformer:
         self.s3_bucket_name = s3_bucket_name
         self.s3_partition_prefix = s3_partition_prefix
         self.region_name = REGION_NAME
+        self.validation_schema = VALIDATION_SCHEMA
+        self.staging_storage = staging_storage or S3StagingStorage(
+            s3_bucket_name, aws_access_key_id, aws_secret_access_key, REGION_NAME
+        )
+        self.performance_history = performance_history
+        self.output_file_count = output_file_count
+        self.row_hash_index_retention_days = row_hash_index_retention_days
+        self.run_metrics = {}
 
-    def download_from_s3(self):
-        # Download the raw extracted data from S3
-        self.logger.info("Downloading data from S3")
+    def download_from_s3(self, s3_object_key=RAW_S3_OBJECT_KEY):
+        # Read the raw extracted data from the staging area
+        self.logger.info(f"Downloading data from {self.staging_storage.describe(s3_object_key)}")
         try:
-            s3 = boto3.client(
-                "s3",
-                aws_access_key_id=self.aws_access_key_id,
-                aws_secret_access_key=self.aws_secret_access_key,
-            )
-            csv_buffer = io.BytesIO()
-            s3.download_fileobj(self.s3_bucket_name, "data/delivery_attempts.csv", csv_buffer)
-            csv_buffer.seek(0)
-            self.logger.info(f"Downloaded data size: {csv_buffer.getbuffer().nbytes} bytes")
-            return csv_buffer
+            df_raw = self.staging_storage.read_frame(s3_object_key)
+            self.logger.info(f"Downloaded {len(df_raw)} raw records")
+            return df_raw
         except Exception as e:
-            self.logger.error(f"{self.msg_text}: Error downloading from S3: {e}")
+            self.logger.error(f"{self.msg_text}: Error downloading from staging: {e}")
             raise
 
-    def flatten_mongo_data(self, csv_buffer):
+    def flatten_mongo_data(self, df_raw):
         # Flatten nested MongoDB records into a flat DataFrame
         self.logger.info("Flattening MongoDB data")
         try:
-            csv_buffer.seek(0)
-            df_csv = pd.read_csv(csv_buffer)
-            dict_flattened = (flatten(record, ".") for record in df_csv.to_dict(orient="records"))
+            dict_flattened = (flatten(record, ".") for record in df_raw.to_dict(orient="records"))
             df = pd.DataFrame(dict_flattened)
             self.logger.info(f"Flattened {len(df)} records from MongoDB")
             return df
@@ -123,6 +132,53 @@ class DataTransformer:
             self.logger.error(error_message)
             raise
 
+    def quarantine_rows_to_s3(self, quarantined_df, raw_s3_object_key):
+        # Write rejected rows with their violation reasons to a side object instead of failing the batch
+        quarantine_key = f"{QUARANTINE_S3_PREFIX}{datetime.utcnow().strftime('%Y%m%dT%H%M%S')}_{os.path.basename(raw_s3_object_key)}"
+        self.logger.info(f"Quarantining {len(quarantined_df)} rows to {self.staging_storage.describe(quarantine_key)}")
+        try:
+            csv_buffer = io.StringIO()
+            quarantined_df.to_csv(csv_buffer, index=False)
+            self.staging_storage.write_bytes(quarantine_key, csv_buffer.getvalue())
+            return quarantine_key
+        except Exception as e:
+            self.logger.error(f"{self.msg_text}: Error uploading quarantined rows: {str(e)}")
+            raise
+
+    def extract_batch_watermark(self, df_selected):
+        # Latest updatedAt in the batch, quarantined rows included so they are not extracted again;
+        # None when the batch has no parseable updatedAt, so the watermark is left alone
+        if "updatedAt" not in df_selected.columns:
+            return None
+        latest = pd.to_datetime(df_selected["updatedAt"], errors="coerce", format="ISO8601").max()
+        return None if pd.isna(latest) else latest.strftime("%Y-%m-%d %H:%M:%S")
+
+    def validate_rows(self, df_selected, raw_s3_object_key=RAW_S3_OBJECT_KEY):
+        # Check types, nullability, max lengths and allowed values before astype can fail on them
+        self.logger.info("Validating rows against schema")
+        try:
+            violations, parsed_columns = find_schema_violations(df_selected, self.validation_schema)
+            invalid_mask = violations.any(axis=1).to_numpy() if len(violations.columns) else np.zeros(len(df_selected), dtype=bool)
+            rows_invalid = int(invalid_mask.sum())
+            self.run_metrics["rows_quarantined"] = rows_invalid
+            if rows_invalid:
+                invalid_violations = violations[invalid_mask]
+                # bool x str dot product concatenates the names of the rules each row broke
+                reasons = invalid_violations.dot(invalid_violations.columns + ";").str.rstrip(";")
+                quarantined_df = df_selected[invalid_mask].assign(validation_errors=reasons)
+                self.run_metrics["quarantine_s3_object_key"] = self.quarantine_rows_to_s3(quarantined_df, raw_s3_object_key)
+                violation_counts = invalid_violations.sum()
+                self.logger.warning(f"Quarantined {rows_invalid} of {len(df_selected)} rows: {violation_counts[violation_counts > 0].to_dict()}")
+            valid_df = df_selected[~invalid_mask].copy() if rows_invalid else df_selected
+            for col, parsed in parsed_columns.items():
+                valid_df[col] = parsed[~invalid_mask] if rows_invalid else parsed
+            self.logger.info("Row validation completed successfully")
+            return valid_df
+        except Exception as validation_error:
+            error_message = f"{self.msg_text}: deliveryAttempts, row validation Error: {str(validation_error)}"
+            self.logger.error(error_message)
+            raise
+
     def apply_data_types_and_handle_missing_columns(self, df_selected):
         # Make sure all columns exist and have the right types
         self.logger.info("Applying data types and handling missing columns")
@@ -133,6 +189,10 @@ class DataTransformer:
                     df_selected[column_name] = ""
             int_float_columns = [col for col, dtype in data_types.items() if dtype in ["int", "int64"]]
             df_selected[int_float_columns] = df_selected[int_float_columns].fillna(0)
+            # astype(bool) would turn NaN and the string "False" into True, so map the values first
+            bool_columns = [col for col, dtype in data_types.items() if dtype is bool or dtype == "bool"]
+            for col in bool_columns:
+                df_selected[col] = normalize_tristate_boolean(df_selected[col]).fillna(False)
             df_selected = df_selected.astype(data_types)
             self.logger.info("Data types applied successfully")
             return df_selected
@@ -146,14 +206,13 @@ class DataTransformer:
         self.logger.info("Cleaning string columns and handling NaN values")
         try:
             data_types = self.data_types
-            str_columns = [col for col, dtype in data_types.items() if dtype == "str"]
-            for col in str_columns:
-                if col in df_selected.columns:
-                    df_selected[col].replace({np.nan: "", "nan": "", "NAN": "", "NaN": "", "NaT": ""}, inplace=True)
+            str_columns = [col for col, dtype in data_types.items() if dtype == "str" and col in df_selected.columns]
+            if str_columns:
+                df_selected[str_columns] = normalize_nan_tokens(df_selected[str_columns])
             self.logger.info("String columns cleaned successfully")
             return df_selected
         except Exception as clean_error:
-            error_message = f"{self.MSG_TEXT}: deliveryAttempts, string cleaning Error: {str(clean_error)}"
+            error_message = f"{self.msg_text}: deliveryAttempts, string cleaning Error: {str(clean_error)}"
             self.logger.error(error_message)
             raise
 
@@ -161,13 +220,13 @@ class DataTransformer:
         # Truncate long string columns to fit Redshift limits
         self.logger.info("Truncating string columns to limits")
         try:
-            columns_to_truncate = ["business_name", "star_name"]
-            if any(col in df_selected.columns for col in columns_to_truncate):
-                df_selected[columns_to_truncate] = df_selected[columns_to_truncate].apply(lambda x: x.str.slice(0, 300))
-            if "exception_reason" in df_selected.columns:
-                df_selected["exception_reason"] = df_selected["exception_reason"].str.strip().str.slice(0, 200)
-            if "consignee_name" in df_selected.columns:
-                df_selected["consignee_name"] = df_selected["consignee_name"].str.strip().str.slice(0, 150)
+            max_lengths = {"business_name": 300, "star_name": 300, "exception_reason": 200, "consignee_name": 150}
+            strip_columns = ["exception_reason", "consignee_name"]
+            columns_to_truncate = [col for col in max_lengths if col in df_selected.columns]
+            if columns_to_truncate:
+                df_selected[columns_to_truncate] = strip_and_truncate(
+                    df_selected[columns_to_truncate], max_lengths, strip_columns
+                )
             self.logger.info("String columns truncated successfully")
             return df_selected
         except Exception as truncate_error:
@@ -176,21 +235,12 @@ class DataTransformer:
             raise
 
     def handle_final_boolean_column_processing(self, insert_df):
-        # Final pass to ensure boolean columns are correct
+        # Final pass to ensure boolean columns are correct, unknown values end up as False
         self.logger.info("Handling final boolean column processing")
         try:
-            if "exception_whatsAppVerification_verified" in insert_df.columns:
-                insert_df["exception_whatsAppVerification_verified"].replace("nan", np.nan, inplace=True)
-                insert_df["exception_whatsAppVerification_verified"] = insert_df[
-                    "exception_whatsAppVerification_verified"
-                ].astype("bool", errors="ignore")
-                insert_df["exception_whatsAppVerification_verified"].fillna(False, inplace=True)
-            if "exception_whatsAppVerification_fakeAttempt" in insert_df.columns:
-                insert_df["exception_whatsAppVerification_fakeAttempt"].replace("nan", np.nan, inplace=True)
-                insert_df["exception_whatsAppVerification_fakeAttempt"] = insert_df[
-                    "exception_whatsAppVerification_fakeAttempt"
-                ].astype("bool", errors="ignore")
-                insert_df["exception_whatsAppVerification_fakeAttempt"].fillna(False, inplace=True)
+            for col in ["exception_whatsAppVerification_verified", "exception_whatsAppVerification_fakeAttempt"]:
+                if col in insert_df.columns:
+                    insert_df[col] = normalize_tristate_boolean(insert_df[col]).fillna(False)
             self.logger.info("Final boolean columns processed successfully")
             return insert_df
         except Exception as boolean_error:
@@ -217,51 +267,150 @@ class DataTransformer:
         self.logger.info("Final datetime columns formatted successfully")
         return insert_df
 
-    def upload_to_s3(self, final_transformed_data):
-        # Upload the transformed data to S3 for loading into Redshift
-        self.logger.info("Uploading data to S3")
+    def compute_row_hashes(self, insert_df):
+        # Hash every loaded column except updatedAt, so a document whose only change is its timestamp hashes the same
+        hash_columns = [col for col in self.data_types if col in insert_df.columns and col != "updatedAt"]
+        return pd.util.hash_pandas_object(insert_df[hash_columns], index=False).to_numpy()
+
+    def download_row_hash_index(self):
+        # Fetch the id -> (hash, last_seen) index from staging, an empty index on the first run
+        self.logger.info("Downloading row hash index from staging")
+        try:
+            if not self.staging_storage.exists(ROW_HASH_INDEX_KEY):
+                self.logger.info("No row hash index found, every row counts as changed")
+                return pd.DataFrame(
+                    {"row_hash": pd.Series(dtype="uint64"), "last_seen": pd.Series(dtype="datetime64[ns]")},
+                    index=pd.Index([], dtype=object, name="id"),
+                )
+            with self.staging_storage.open_buffer(ROW_HASH_INDEX_KEY) as source:
+                index_df = pd.read_parquet(source)
+            if "last_seen" not in index_df.columns:
+                # Indexes written before pruning existed start their retention clock now
+                index_df["last_seen"] = pd.Timestamp(datetime.utcnow())
+            self.logger.info(f"Loaded row hash index with {len(index_df)} ids")
+            return index_df.set_index("id")
+        except Exception as e:
+            self.logger.error(f"{self.msg_text}: Error downloading row hash index: {str(e)}")
+            raise
+
+    def upload_row_hash_index(self, row_hash_index):
+        # Stage the updated index next to the transformed file for the load phase to promote
+        self.logger.info(f"Uploading pending row hash index with {len(row_hash_index)} ids")
+        try:
+            parquet_buffer = io.BytesIO()
+            row_hash_index.reset_index().to_parquet(parquet_buffer, index=False)
+            self.staging_storage.write_bytes(PENDING_ROW_HASH_INDEX_KEY, parquet_buffer.getvalue())
+        except Exception as e:
+            self.logger.error(f"{self.msg_text}: Error uploading row hash index: {str(e)}")
+            raise
+
+    def filter_unchanged_rows(self, insert_df):
+        # Drop rows whose content hash matches the last loaded version of the same id
+        self.logger.info("Filtering unchanged rows by content hash")
         try:
-            self.s3_client = boto3.client(
-                "s3",
-                aws_access_key_id=self.aws_access_key_id,
-                aws_secret_access_key=self.aws_secret_access_key,
-                region_name=self.region_name,
+            row_hashes = self.compute_row_hashes(insert_df)
+            row_hash_index = self.download_row_hash_index()
+            # Positional lookup keeps the uint64 hashes exact, Series.map would go through float64 for missing ids
+            positions = row_hash_index.index.get_indexer(insert_df["id"])
+            unchanged_mask = np.zeros(len(insert_df), dtype=bool)
+            found = positions >= 0
+            if found.any():
+                unchanged_mask[found] = row_hash_index["row_hash"].to_numpy()[positions[found]] == row_hashes[found]
+            changed_df = insert_df[~unchanged_mask]
+
+            now = pd.Timestamp(datetime.utcnow())
+            incoming = pd.DataFrame(
+                {"row_hash": row_hashes, "last_seen": now}, index=pd.Index(insert_df["id"].to_numpy(), name="id")
             )
+            incoming = incoming[~incoming.index.duplicated(keep="last")]
+            kept_index = row_hash_index[~row_hash_index.index.isin(incoming.index)]
+            updated_index = pd.concat([kept_index, incoming]) if len(kept_index) else incoming
+            # Keep the index bounded: ids not seen for the retention period are dropped and simply
+            # count as changed (reloaded, then removed by the duplicate cleanup) if they come back
+            cutoff = now - pd.Timedelta(days=self.row_hash_index_retention_days)
+            updated_index = updated_index[updated_index["last_seen"] >= cutoff]
+            self.upload_row_hash_index(updated_index)
+
+            rows_in = len(insert_df)
+            rows_unchanged = int(unchanged_mask.sum())
+            self.run_metrics["rows_before_change_filter"] = rows_in
+            self.run_metrics["rows_unchanged"] = rows_unchanged
+            self.run_metrics["change_filter_ratio"] = rows_unchanged / rows_in if rows_in else 0.0
+            self.run_metrics["row_hash_index_size"] = len(updated_index)
+            self.logger.info(f"Dropped {rows_unchanged} of {rows_in} rows with no content change")
+            return changed_df
+        except Exception as filter_error:
+            error_message = f"{self.msg_text}: deliveryAttempts, change detection Error: {str(filter_error)}"
+            self.logger.error(error_message)
+            raise
+
+    def upload_to_s3(self, final_transformed_data, s3_object_key=None):
+        # Stage the transformed data as CSV for loading into Redshift. With output_file_count > 1 the
+        # rows are split into that many files so every Redshift slice has one to load in parallel.
+        self.logger.info("Uploading transformed data to staging")
+        try:
             yesterday_date = date.today() - timedelta(days=1)
-            csv_buffer = io.StringIO()
-            final_transformed_data.to_csv(csv_buffer, index=False)
-            csv_buffer.seek(0)
-            s3_object_key = f"{self.s3_partition_prefix}{yesterday_date.strftime('%Y-%m-%d')}.csv"
-            self.s3_client.put_object(
-                Bucket=self.s3_bucket_name,
-                Key=s3_object_key,
-                Body=csv_buffer.getvalue(),
-            )
-            return s3_object_key
+            if s3_object_key is None:
+                s3_object_key = f"{self.s3_partition_prefix}{yesterday_date.strftime('%Y-%m-%d')}.csv"
+            if self.output_file_count <= 1:
+                csv_buffer = io.StringIO()
+                final_transformed_data.to_csv(csv_buffer, index=False)
+                self.staging_storage.write_bytes(s3_object_key, csv_buffer.getvalue())
+                self.logger.info(f"Uploaded transformed data to {self.staging_storage.describe(s3_object_key)}")
+                return s3_object_key
+            key_root, key_ext = os.path.splitext(s3_object_key)
+            s3_object_keys = []
+            for part, positions in enumerate(np.array_split(np.arange(len(final_transformed_data)), self.output_file_count)):
+                # Skip empty parts of a small batch, but always stage at least one file
+                if not len(positions) and s3_object_keys:
+                    continue
+                part_key = f"{key_root}.part{part:04d}{key_ext}"
+                csv_buffer = io.StringIO()
+                final_transformed_data.iloc[positions].to_csv(csv_buffer, index=False)
+                self.staging_storage.write_bytes(part_key, csv_buffer.getvalue())
+                s3_object_keys.append(part_key)
+            self.logger.info(f"Uploaded transformed data to {len(s3_object_keys)} files under {self.staging_storage.describe(key_root)}")
+            return s3_object_keys
         except Exception as e:
             self.logger.error(f"{self.msg_text}: S3 upload Error: {str(e)}")
             raise
 
-    def run_transformation(self):
+    def run_transformation(self, raw_s3_object_key=RAW_S3_OBJECT_KEY, s3_object_key=None, detect_changes=True, run_id=None):
         # Main entry point for the transformation phase
         self.logger.info("Starting transformation phase")
+        self.run_metrics = {}
+        recorder = RunRecorder("transform", run_id)
+        step = recorder.call
+        status = "failed"
         try:
-            data = self.download_from_s3()
-            df_flattened = self.flatten_mongo_data(data)
-            df_selected = self.select_required_columns(df_flattened)
-            df_selected = self.clean_column_names(df_selected)
-            df_selected = self.rename_columns_to_standard_format(df_selected)
-            df_selected = self.handle_initial_boolean_columns(df_selected)
-            df_selected = self.apply_data_types_and_handle_missing_columns(df_selected)
-            df_selected = self.clean_string_columns_and_handle_nan_values(df_selected)
-            df_selected = self.truncate_string_columns_to_limits(df_selected)
-            insert_df = self.handle_final_boolean_column_processing(df_selected)
-            final_transformed_data = self.handle_final_datetime_column_formatting(insert_df)
-            s3_object_key = self.upload_to_s3(final_transformed_data)
-            last_updated_at = final_transformed_data["updatedAt"].max() if "updatedAt" in final_transformed_data.columns else None
+            data = step("download_from_s3", self.download_from_s3, raw_s3_object_key)
+            recorder.batch_rows = len(data)
+            df_flattened = step("flatten_mongo_data", self.flatten_mongo_data, data)
+            df_selected = step("select_required_columns", self.select_required_columns, df_flattened)
+            df_selected = step("clean_column_names", self.clean_column_names, df_selected)
+            df_selected = step("rename_columns_to_standard_format", self.rename_columns_to_standard_format, df_selected)
+            df_selected = step("handle_initial_boolean_columns", self.handle_initial_boolean_columns, df_selected)
+            # Take the watermark before validation and change detection, either may drop every row of the batch
+            last_updated_at = self.extract_batch_watermark(df_selected)
+            df_selected = step("validate_rows", self.validate_rows, df_selected, raw_s3_object_key)
+            df_selected = step("apply_data_types_and_handle_missing_columns", self.apply_data_types_and_handle_missing_columns, df_selected)
+            df_selected = step("clean_string_columns_and_handle_nan_values", self.clean_string_columns_and_handle_nan_values, df_selected)
+            df_selected = step("truncate_string_columns_to_limits", self.truncate_string_columns_to_limits, df_selected)
+            insert_df = step("handle_final_boolean_column_processing", self.handle_final_boolean_column_processing, df_selected)
+            final_transformed_data = step("handle_final_datetime_column_formatting", self.handle_final_datetime_column_formatting, insert_df)
+            if detect_changes:
+                final_transformed_data = step("filter_unchanged_rows", self.filter_unchanged_rows, final_transformed_data)
+            s3_object_key = step("upload_to_s3", self.upload_to_s3, final_transformed_data, s3_object_key)
+            recorder.annotate_rows(len(final_transformed_data))
+            self.run_metrics["rows_loaded"] = len(final_transformed_data)
+            self.logger.info(f"Transformation metrics: {self.run_metrics}")
             self.logger.info("Transformation phase completed successfully")
+            status = "success"
             return last_updated_at, s3_object_key
         except Exception as e:
             error_message = f"{self.msg_text}: Transformation phase failed: {str(e)}"
             self.logger.error(error_message)
             raise
+        finally:
+            if self.performance_history:
+                self.performance_history.append_run(recorder, status, self.run_metrics)